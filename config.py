@@ -2,107 +2,155 @@
 Configuration centralisée pour le backend de génération 3D
 """
 import os
+from dataclasses import dataclass, field
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
 
+BASE_DIR = Path(__file__).parent
+
+# Dossiers déjà créés dans ce processus (create_directories n'agit qu'une fois)
+_DIRS_CREATED = False
+
+
+def _env(name: str, default: Optional[str] = None, cast=str):
+    """Champ lu depuis l'environnement à l'instanciation (et non à l'import)"""
+    def factory():
+        value = os.getenv(name, default)
+        return cast(value) if value is not None else None
+    return field(default_factory=factory)
+
+
+def _env_flag(name: str, default: str = "false"):
+    """Champ booléen lu depuis l'environnement ("true" / "false")"""
+    return _env(name, default, lambda value: value.lower() == "true")
+
+
+@dataclass(frozen=True)
 class Config:
-    """Configuration principale de l'application"""
+    """Configuration principale de l'application (instance unique via get_config)"""
     
     # Serveur
-    HOST: str = os.getenv("HOST", "0.0.0.0")
-    PORT: int = int(os.getenv("PORT", "8000"))
-    WORKERS: int = int(os.getenv("WORKERS", "1"))
+    HOST: str = _env("HOST", "0.0.0.0")
+    PORT: int = _env("PORT", "8000", int)
+    WORKERS: int = _env("WORKERS", "1", int)
     
     # Chemins
-    BASE_DIR: Path = Path(__file__).parent
+    BASE_DIR: Path = BASE_DIR
     UPLOAD_DIR: Path = BASE_DIR / "uploads"
     OUTPUT_DIR: Path = BASE_DIR / "outputs"
     JOBS_DIR: Path = BASE_DIR / "jobs"
     TEMP_DIR: Path = BASE_DIR / "temp"
     
     # Upload
-    MAX_UPLOAD_SIZE_MB: int = int(os.getenv("MAX_UPLOAD_SIZE_MB", "500"))
-    MAX_UPLOAD_SIZE_BYTES: int = MAX_UPLOAD_SIZE_MB * 1024 * 1024
-    ALLOWED_VIDEO_FORMATS: list = ["mp4", "mov", "avi"]
+    MAX_UPLOAD_SIZE_MB: int = _env("MAX_UPLOAD_SIZE_MB", "500", int)
+    ALLOWED_VIDEO_FORMATS: tuple = ("mp4", "mov", "avi")
+    
+    # Téléchargement (préfixe de la location interne Nginx, vide = streaming par l'API)
+    X_ACCEL_REDIRECT_PREFIX: Optional[str] = _env("X_ACCEL_REDIRECT_PREFIX", "", lambda value: value or None)
     
     # Processing
-    MAX_CONCURRENT_JOBS: int = int(os.getenv("MAX_CONCURRENT_JOBS", "2"))
-    CLEANUP_TEMP_FILES: bool = os.getenv("CLEANUP_TEMP_FILES", "true").lower() == "true"
+    MAX_CONCURRENT_JOBS: int = _env("MAX_CONCURRENT_JOBS", "2", int)
+    # Pipelines GPU simultanés par process (chaque entraînement suppose la VRAM pour lui seul).
+    # Sémaphore propre au process: le backend Gaussian Splatting doit tourner avec
+    # `--workers 1`. Avec GS_PERSISTENT_WORKER, les entraînements restent un par un
+    # (seules les étapes COLMAP se chevauchent au-delà de 1).
+    GPU_SLOTS: int = _env("GPU_SLOTS", "1", int)
+    CLEANUP_TEMP_FILES: bool = _env_flag("CLEANUP_TEMP_FILES", "true")
     
     # Gaussian Splatting
-    GAUSSIAN_SPLATTING_PATH: Path = Path(os.getenv(
-        "GAUSSIAN_SPLATTING_PATH", 
-        "/workspace/gaussian-splatting"
-    ))
-    ITERATIONS: int = int(os.getenv("ITERATIONS", "7000"))
-    DENSIFY_UNTIL_ITER: int = int(os.getenv("DENSIFY_UNTIL_ITER", "5000"))
-    DENSIFICATION_INTERVAL: int = int(os.getenv("DENSIFICATION_INTERVAL", "100"))
+    GAUSSIAN_SPLATTING_PATH: Path = _env("GAUSSIAN_SPLATTING_PATH", "/workspace/gaussian-splatting", Path)
+    ITERATIONS: int = _env("ITERATIONS", "7000", int)
+    DENSIFY_UNTIL_ITER: int = _env("DENSIFY_UNTIL_ITER", "5000", int)
+    DENSIFICATION_INTERVAL: int = _env("DENSIFICATION_INTERVAL", "100", int)
+    # train.py dans un process persistant (false = un nouveau process python par job),
+    # ignoré si WORKERS > 1: un contexte CUDA par worker uvicorn
+    GS_PERSISTENT_WORKER: bool = _env_flag("GS_PERSISTENT_WORKER", "true")
     
     # Nerfstudio
-    MAX_NUM_ITERATIONS: int = int(os.getenv("MAX_NUM_ITERATIONS", "10000"))
-    NUM_FRAMES_TARGET: int = int(os.getenv("NUM_FRAMES_TARGET", "50"))
+    MAX_NUM_ITERATIONS: int = _env("MAX_NUM_ITERATIONS", "10000", int)
+    NUM_FRAMES_TARGET: int = _env("NUM_FRAMES_TARGET", "50", int)
+    
+    # Frames extraites: plus grand côté max en pixels (réduit le coût SIFT de COLMAP).
+    # Toutes les frames d'une vidéo ont la même taille, les intrinsèques restent cohérentes.
+    FRAME_MAX_DIM: int = _env("FRAME_MAX_DIM", "1920", int)
+    
+    # Qualité JPEG des frames: le SIFT de COLMAP reste stable jusqu'à ~85
+    FRAME_JPEG_QUALITY: int = _env("FRAME_JPEG_QUALITY", "85", int)
+    
+    # COLMAP: arbre de vocabulaire (loop detection et vocab_tree_matcher), optionnel
+    COLMAP_VOCAB_TREE_PATH: Optional[Path] = _env("COLMAP_VOCAB_TREE_PATH", "", lambda value: Path(value) if value else None)
+    # Sans chemin local, téléchargé une fois dans jobs/.cache par le backend Gaussian Splatting (vide = désactivé)
+    COLMAP_VOCAB_TREE_URL: str = _env("COLMAP_VOCAB_TREE_URL", "https://demuc.de/colmap/vocab_tree_flickr100K_words32K.bin")
     
     # Sécurité
-    API_KEY: Optional[str] = os.getenv("API_KEY")
-    ENABLE_AUTH: bool = os.getenv("ENABLE_AUTH", "false").lower() == "true"
+    API_KEY: Optional[str] = _env("API_KEY")
+    ENABLE_AUTH: bool = _env_flag("ENABLE_AUTH")
     
     # Monitoring
-    LOG_LEVEL: str = os.getenv("LOG_LEVEL", "info")
-    ENABLE_METRICS: bool = os.getenv("ENABLE_METRICS", "false").lower() == "true"
+    LOG_LEVEL: str = _env("LOG_LEVEL", "info")
+    ENABLE_METRICS: bool = _env_flag("ENABLE_METRICS")
     
     # RunPod (optionnel)
-    RUNPOD_API_KEY: Optional[str] = os.getenv("RUNPOD_API_KEY")
-    RUNPOD_POD_ID: Optional[str] = os.getenv("RUNPOD_POD_ID")
+    RUNPOD_API_KEY: Optional[str] = _env("RUNPOD_API_KEY")
+    RUNPOD_POD_ID: Optional[str] = _env("RUNPOD_POD_ID")
     
-    @classmethod
-    def create_directories(cls):
-        """Créer tous les dossiers nécessaires"""
-        for dir_path in [cls.UPLOAD_DIR, cls.OUTPUT_DIR, cls.JOBS_DIR, cls.TEMP_DIR]:
-            dir_path.mkdir(exist_ok=True, parents=True)
+    @property
+    def MAX_UPLOAD_SIZE_BYTES(self) -> int:
+        return self.MAX_UPLOAD_SIZE_MB * 1024 * 1024
     
-    @classmethod
-    def validate(cls):
+    def create_directories(self):
+        """Créer tous les dossiers nécessaires (une seule fois par processus)"""
+        global _DIRS_CREATED
+        if _DIRS_CREATED:
+            return
+        
+        for dir_path in (self.UPLOAD_DIR, self.OUTPUT_DIR, self.JOBS_DIR, self.TEMP_DIR):
+            os.makedirs(dir_path, exist_ok=True)
+        
+        _DIRS_CREATED = True
+    
+    def validate(self):
         """Valider la configuration"""
         errors = []
         
         # Vérifier Gaussian Splatting
-        if not cls.GAUSSIAN_SPLATTING_PATH.exists():
-            errors.append(f"Gaussian Splatting non trouvé: {cls.GAUSSIAN_SPLATTING_PATH}")
+        if not self.GAUSSIAN_SPLATTING_PATH.exists():
+            errors.append(f"Gaussian Splatting non trouvé: {self.GAUSSIAN_SPLATTING_PATH}")
         
         # Vérifier l'authentification
-        if cls.ENABLE_AUTH and not cls.API_KEY:
+        if self.ENABLE_AUTH and not self.API_KEY:
             errors.append("ENABLE_AUTH=true mais API_KEY non défini")
         
         if errors:
             raise ValueError("Erreurs de configuration:\n" + "\n".join(errors))
     
-    @classmethod
-    def print_config(cls):
+    def print_config(self):
         """Afficher la configuration (sans les secrets)"""
         print("=" * 60)
         print("CONFIGURATION DU BACKEND")
         print("=" * 60)
-        print(f"Serveur: {cls.HOST}:{cls.PORT}")
-        print(f"Workers: {cls.WORKERS}")
-        print(f"Upload max: {cls.MAX_UPLOAD_SIZE_MB} MB")
-        print(f"Formats vidéo: {', '.join(cls.ALLOWED_VIDEO_FORMATS)}")
-        print(f"Jobs simultanés: {cls.MAX_CONCURRENT_JOBS}")
-        print(f"Gaussian Splatting: {cls.GAUSSIAN_SPLATTING_PATH}")
-        print(f"Itérations: {cls.ITERATIONS}")
-        print(f"Authentification: {'Activée' if cls.ENABLE_AUTH else 'Désactivée'}")
-        print(f"Métriques: {'Activées' if cls.ENABLE_METRICS else 'Désactivées'}")
+        print(f"Serveur: {self.HOST}:{self.PORT}")
+        print(f"Workers: {self.WORKERS}")
+        print(f"Upload max: {self.MAX_UPLOAD_SIZE_MB} MB")
+        print(f"Formats vidéo: {', '.join(self.ALLOWED_VIDEO_FORMATS)}")
+        print(f"Jobs simultanés: {self.MAX_CONCURRENT_JOBS}")
+        print(f"Gaussian Splatting: {self.GAUSSIAN_SPLATTING_PATH}")
+        print(f"Itérations: {self.ITERATIONS}")
+        print(f"Authentification: {'Activée' if self.ENABLE_AUTH else 'Désactivée'}")
+        print(f"Métriques: {'Activées' if self.ENABLE_METRICS else 'Désactivées'}")
         print("=" * 60)
 
 
-# Configuration par défaut
-config = Config()
-
-# Créer les dossiers au démarrage
-config.create_directories()
+@lru_cache(maxsize=1)
+def get_config() -> Config:
+    """Configuration lue depuis l'environnement au premier appel, puis partagée"""
+    return Config()
 
 
 if __name__ == "__main__":
     # Test de la configuration
+    config = get_config()
     try:
         config.validate()
         config.print_config()
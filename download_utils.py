@@ -0,0 +1,217 @@
+"""
+Réponses de téléchargement des modèles 3D générés
+"""
+import os
+import re
+from email.utils import formatdate
+from pathlib import Path
+from typing import Optional
+
+import aiofiles
+from fastapi import HTTPException
+from fastapi.responses import Response, StreamingResponse
+
+try:
+    import zstandard
+except ImportError:  # zstd optionnel: fichiers envoyés non compressés
+    zstandard = None
+
+# Taille des blocs envoyés en streaming
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Niveau zstd des copies précompressées (bon ratio sur les float32 des PLY, compression rapide)
+ZSTD_LEVEL = 3
+
+# Une seule plage: "bytes=debut-fin", "bytes=debut-" ou "bytes=-suffixe"
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def resolve_download_path(output_dir: Path, filename: str) -> Path:
+    """
+    Chemin du fichier demandé dans output_dir
+
+    Refuse les noms qui sortiraient du dossier (../, sous-dossiers, fichiers cachés).
+    """
+    if Path(filename).name != filename or filename.startswith("."):
+        raise HTTPException(400, "Nom de fichier invalide")
+
+    file_path = output_dir / filename
+
+    if not file_path.is_file():
+        raise HTTPException(404, "Fichier non trouvé")
+
+    return file_path
+
+
+def write_zstd_copy(file_path: Path) -> Optional[Path]:
+    """
+    Écrit la copie précompressée `<fichier>.zst` servie aux clients qui acceptent zstd
+
+    Returns:
+        Chemin de la copie, None si le module zstandard n'est pas installé
+    """
+    if zstandard is None:
+        return None
+
+    zst_path = file_path.with_name(f"{file_path.name}.zst")
+    tmp_path = file_path.with_name(f".{file_path.name}.zst.tmp")
+
+    try:
+        with open(file_path, "rb") as src, open(tmp_path, "wb") as dst:
+            zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1).copy_stream(src, dst)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    # Renommage atomique: jamais de copie partielle servie
+    os.replace(tmp_path, zst_path)
+    return zst_path
+
+
+def accepts_zstd(accept_encoding: Optional[str]) -> bool:
+    """Le client annonce zstd dans Accept-Encoding (et ne l'exclut pas avec q=0)"""
+    for coding in (accept_encoding or "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() != "zstd":
+            continue
+
+        _, _, quality = params.partition("q=")
+        try:
+            return float(quality) > 0 if quality.strip() else True
+        except ValueError:
+            return True
+
+    return False
+
+
+def parse_range(range_header: str, size: int) -> Optional[tuple]:
+    """
+    Plage (début, fin incluse) demandée par l'en-tête Range
+
+    Retourne None si l'en-tête n'est pas géré ou invalide (plages multiples,
+    autre unité, fin avant le début): le fichier est alors envoyé en entier
+    (RFC 9110). Lève une HTTPException 416 si la plage est hors du fichier.
+    """
+    match = RANGE_RE.match(range_header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+
+    first, last = match.groups()
+
+    # "bytes=5-3": syntaxiquement invalide, l'en-tête est ignoré
+    if first and last and int(last) < int(first):
+        return None
+
+    if first == "":
+        # Suffixe: les N derniers octets ("bytes=-0" n'est pas satisfaisable)
+        suffix = int(last)
+        start = size - min(suffix, size) if suffix else size
+        end = size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+
+    if start >= size or start > end:
+        raise HTTPException(416, "Plage non satisfaisable", headers={"Content-Range": f"bytes */{size}"})
+
+    return start, end
+
+
+async def iter_file(file_path: Path, start: int = 0, length: Optional[int] = None):
+    """Lit le fichier par blocs sans bloquer la boucle d'événements"""
+    async with aiofiles.open(file_path, "rb") as f:
+        await f.seek(start)
+        remaining = length
+
+        while remaining is None or remaining > 0:
+            size = DOWNLOAD_CHUNK_SIZE if remaining is None else min(DOWNLOAD_CHUNK_SIZE, remaining)
+            chunk = await f.read(size)
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+
+def file_validators(stat: os.stat_result, encoding: Optional[str] = None) -> dict:
+    """
+    En-têtes ETag et Last-Modified d'une représentation du fichier
+
+    L'ETag (fort) dépend de la taille, de la date de modification et de
+    l'encodage: la copie zstd et le fichier brut ne se confondent jamais.
+    """
+    etag = f"{stat.st_size:x}-{stat.st_mtime_ns:x}" + (f"-{encoding}" if encoding else "")
+    return {
+        "ETag": f'"{etag}"',
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True)
+    }
+
+
+def file_download_response(
+    file_path: Path,
+    range_header: Optional[str] = None,
+    accel_prefix: Optional[str] = None,
+    accept_encoding: Optional[str] = None,
+    if_range: Optional[str] = None
+) -> Response:
+    """
+    Réponse de téléchargement pour un fichier de sortie, reprise possible (Range)
+
+    Avec accel_prefix (Nginx devant l'API), seul l'en-tête X-Accel-Redirect
+    est renvoyé et Nginx envoie le fichier avec sendfile() en gérant lui-même
+    les plages. Sinon le fichier est streamé par blocs de 1 Mo, en 206 si
+    une plage est demandée.
+
+    Si une copie `<fichier>.zst` existe et que le client accepte zstd, elle est
+    envoyée à la place avec Content-Encoding: zstd (les plages portent alors
+    sur les octets compressés).
+
+    Chaque représentation porte un ETag: une reprise avec If-Range qui ne
+    correspond plus (fichier régénéré, autre encodage) reçoit le fichier
+    entier en 200 plutôt qu'une plage d'un autre contenu.
+    """
+    headers = {
+        "Content-Disposition": f'attachment; filename="{file_path.name}"',
+        "Accept-Ranges": "bytes"
+    }
+
+    if accel_prefix:
+        headers["X-Accel-Redirect"] = f"{accel_prefix.rstrip('/')}/{file_path.name}"
+        return Response(media_type="application/octet-stream", headers=headers)
+
+    zst_path = file_path.with_name(f"{file_path.name}.zst")
+    if zst_path.is_file():
+        headers["Vary"] = "Accept-Encoding"
+        if accepts_zstd(accept_encoding):
+            headers["Content-Encoding"] = "zstd"
+            file_path = zst_path
+
+    stat = file_path.stat()
+    size = stat.st_size
+    headers.update(file_validators(stat, headers.get("Content-Encoding")))
+
+    # If-Range: ETag ou date exacts de la représentation, sinon la plage est ignorée
+    if if_range is not None and if_range.strip() not in (headers["ETag"], headers["Last-Modified"]):
+        range_header = None
+
+    byte_range = parse_range(range_header, size) if range_header else None
+
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(
+            iter_file(file_path),
+            media_type="application/octet-stream",
+            headers=headers
+        )
+
+    start, end = byte_range
+    length = end - start + 1
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(length)
+
+    return StreamingResponse(
+        iter_file(file_path, start, length),
+        status_code=206,
+        media_type="application/octet-stream",
+        headers=headers
+    )
@@ -0,0 +1,199 @@
+"""
+Process d'entraînement Gaussian Splatting persistant
+
+torch, le contexte CUDA et les modules du repo gaussian-splatting sont
+chargés une seule fois: chaque job exécute train.py dans ce process au lieu
+de payer un nouvel interpréteur et une nouvelle initialisation CUDA.
+"""
+import asyncio
+import gc
+import importlib
+import multiprocessing
+import os
+import queue
+import runpy
+import sys
+import traceback
+from pathlib import Path
+
+# Allocateur CUDA de PyTorch: limite la fragmentation sur des entraînements enchaînés
+CUDA_ALLOC_CONF = "max_split_size_mb:512,expandable_segments:True"
+
+# Attente maximale de l'arrêt propre du process avant terminate()
+STOP_TIMEOUT = 10
+
+
+def _load_training_modules():
+    """Précharge torch (contexte CUDA) et les imports de train.py"""
+    import torch
+
+    if torch.cuda.is_available():
+        torch.cuda.init()
+
+    importlib.import_module("train")
+
+    # network_gui.init() lie un socket d'écoute global: un second appel dans
+    # le même process échouerait (adresse déjà liée)
+    from gaussian_renderer import network_gui
+
+    init = network_gui.init
+    initialized = False
+
+    def init_once(*args, **kwargs):
+        nonlocal initialized
+        if not initialized:
+            initialized = True
+            init(*args, **kwargs)
+
+    network_gui.init = init_once
+
+
+def _run_train(train_args: list, log_path: str) -> int:
+    """
+    Exécute train.py comme en ligne de commande, sorties redirigées vers log_path
+
+    Returns:
+        Code de retour équivalent à celui du script
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    saved_fds = os.dup(1), os.dup(2)
+    saved_stdout = sys.stdout
+    sys.argv = ["train.py", *train_args]
+
+    # open() dans le try: un log impossible à ouvrir fait échouer le job, pas le process
+    try:
+        with open(log_path, "ab", buffering=0) as log:
+            os.dup2(log.fileno(), 1)
+            os.dup2(log.fileno(), 2)
+            runpy.run_path("train.py", run_name="__main__")
+        returncode = 0
+    except SystemExit as e:
+        returncode = e.code if isinstance(e.code, int) else int(e.code is not None)
+    except Exception:
+        # fd 2 pointe encore sur le log (s'il a pu être ouvert)
+        traceback.print_exc(file=sys.__stderr__)
+        returncode = 1
+    finally:
+        # safe_state() de train.py remplace sys.stdout
+        sys.stdout = saved_stdout
+        sys.__stdout__.flush()
+        sys.__stderr__.flush()
+        os.dup2(saved_fds[0], 1)
+        os.dup2(saved_fds[1], 2)
+        os.close(saved_fds[0])
+        os.close(saved_fds[1])
+
+    return returncode
+
+
+def _release_cuda_memory():
+    """Rend au driver la VRAM du job terminé (modèle, optimiseur, caméras)"""
+    import torch
+
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def _worker_main(gs_path: str, jobs, results):
+    """Boucle du process: un job (arguments, log) à la fois, None pour arrêter"""
+    # Lu par PyTorch à l'initialisation de CUDA: avant tout import de torch
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", CUDA_ALLOC_CONF)
+
+    os.chdir(gs_path)
+    sys.path.insert(0, gs_path)
+    _load_training_modules()
+
+    while (job := jobs.get()) is not None:
+        train_args, log_path = job
+        returncode = _run_train(train_args, log_path)
+        _release_cuda_memory()
+        results.put(returncode)
+
+
+class TrainingWorker:
+    """
+    Process persistant qui exécute train.py (démarré en spawn, CUDA ne
+    supportant pas fork)
+
+    Après un échec (OOM...) le process est arrêté: le job suivant repart d'un
+    contexte CUDA neuf.
+    """
+
+    def __init__(self, gs_path: Path):
+        self.gs_path = gs_path
+        self._context = multiprocessing.get_context("spawn")
+        self._process = None
+        self._jobs = None
+        self._results = None
+        self._lock = asyncio.Lock()
+
+    def is_alive(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+
+    def start(self):
+        """Démarre le process (chargement de torch en arrière-plan)"""
+        if self.is_alive():
+            return
+
+        self._jobs = self._context.Queue()
+        self._results = self._context.Queue()
+        self._process = self._context.Process(
+            target=_worker_main,
+            args=(str(self.gs_path), self._jobs, self._results),
+            name="gs-trainer",
+            daemon=True
+        )
+        self._process.start()
+        print(f"🧠 Worker d'entraînement démarré (pid {self._process.pid})")
+
+    def stop(self):
+        """Arrête le process après le job en cours"""
+        if self._process is None:
+            return
+
+        if self._process.is_alive():
+            self._jobs.put(None)
+            self._process.join(STOP_TIMEOUT)
+            if self._process.is_alive():
+                self._process.terminate()
+                self._process.join()
+
+        self._process = None
+
+    @staticmethod
+    def _wait_result(process, results) -> int:
+        """
+        Code de retour du job en cours, ou du process s'il est mort entre-temps
+
+        Reçoit le process et sa file plutôt que de relire les attributs:
+        stop() (arrêt de l'API) peut les remettre à None pendant l'attente.
+        """
+        while True:
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                if not process.is_alive():
+                    return process.exitcode or 1
+
+    async def train(self, train_args: list, log_path: Path) -> int:
+        """
+        Exécute train.py avec train_args (mêmes arguments qu'en ligne de commande)
+
+        Returns:
+            Code de retour de l'entraînement
+        """
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            self.start()
+            process, jobs, results = self._process, self._jobs, self._results
+
+            await loop.run_in_executor(None, jobs.put, (train_args, str(log_path)))
+            returncode = await loop.run_in_executor(None, self._wait_result, process, results)
+
+            if returncode != 0:
+                await loop.run_in_executor(None, self.stop)
+
+            return returncode
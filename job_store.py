@@ -0,0 +1,138 @@
+"""
+Stockage des statuts de jobs partagé entre workers (Redis)
+"""
+import asyncio
+import json
+from datetime import datetime
+from typing import Optional
+
+import redis.asyncio as aioredis
+from redis.exceptions import WatchError
+
+# Statuts terminaux: le job expire ensuite automatiquement
+TERMINAL_STATUSES = ("completed", "failed")
+
+# Durée max d'un long-poll (sous les timeouts usuels des proxys et clients HTTP)
+WAIT_TIMEOUT = 25
+
+
+def format_job(job: dict) -> dict:
+    """Ajoute `created_at` (ISO 8601), calculé à la lecture depuis `created_at_ns`"""
+    created_at_ns = job.get("created_at_ns")
+    if created_at_ns is not None:
+        job["created_at"] = datetime.fromtimestamp(created_at_ns / 1e9).isoformat()
+    return job
+
+
+class RedisJobStore:
+    """
+    Statuts de jobs sérialisés en JSON sous les clés `job:{id}`
+
+    Chaque écriture est aussi publiée sur le canal `job:{id}:events`: les
+    long-polls sont réveillés quel que soit le process (API ou worker arq)
+    qui met le job à jour.
+    """
+
+    def __init__(self, url: str, prefix: str = "job:", ttl: int = 86400):
+        self.redis = aioredis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, job_id: str) -> str:
+        return f"{self.prefix}{job_id}"
+
+    def _channel(self, job_id: str) -> str:
+        return f"{self._key(job_id)}:events"
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        """Récupère le statut d'un job (None s'il n'existe pas)"""
+        data = await self.redis.get(self._key(job_id))
+        return json.loads(data) if data is not None else None
+
+    def _queue_write(self, pipe, job_id: str, data: dict):
+        """Ajoute l'écriture et la notification du statut à une transaction"""
+        ttl = self.ttl if data.get("status") in TERMINAL_STATUSES else None
+        payload = json.dumps(data)
+        pipe.set(self._key(job_id), payload, ex=ttl)
+        pipe.publish(self._channel(job_id), payload)
+
+    async def set(self, job_id: str, data: dict):
+        """Enregistre le statut complet d'un job"""
+        async with self.redis.pipeline(transaction=True) as pipe:
+            self._queue_write(pipe, job_id, data)
+            await pipe.execute()
+
+    async def update(self, job_id: str, **fields) -> Optional[dict]:
+        """
+        Met à jour certains champs du statut d'un job
+
+        Lecture et écriture dans une transaction WATCH/MULTI, rejouée si le job
+        a changé entre-temps: aucune mise à jour concurrente n'est perdue.
+        Retourne None, sans rien écrire, si le job n'existe plus (supprimé
+        par DELETE /job pendant son traitement).
+        """
+        key = self._key(job_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(key)
+                    raw = await pipe.get(key)
+                    if raw is None:
+                        await pipe.unwatch()
+                        print(f"⚠️ Mise à jour ignorée, job inexistant: {job_id}")
+                        return None
+
+                    data = json.loads(raw)
+                    data.update(fields)
+
+                    pipe.multi()
+                    self._queue_write(pipe, job_id, data)
+                    await pipe.execute()
+                    return data
+                except WatchError:
+                    continue
+
+    async def wait(self, job_id: str, since: Optional[int] = None, timeout: float = WAIT_TIMEOUT) -> Optional[dict]:
+        """
+        Attend que la progression du job diffère de `since` (long-poll)
+
+        Retourne immédiatement si `since` est None, si la progression a déjà
+        changé ou si le job est terminé; sinon au plus tard après `timeout`
+        secondes, avec le statut courant.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        async with self.redis.pubsub() as pubsub:
+            # Abonnement avant la lecture: aucune mise à jour ne peut être manquée entre les deux
+            await pubsub.subscribe(self._channel(job_id))
+            job = await self.get(job_id)
+
+            while (
+                job is not None
+                and since is not None
+                and job.get("progress") == since
+                and job.get("status") not in TERMINAL_STATUSES
+            ):
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+                if message is not None:
+                    job = json.loads(message["data"])
+
+        return job
+
+    async def delete(self, job_id: str) -> bool:
+        """Supprime un job, retourne False s'il n'existait pas"""
+        return await self.redis.delete(self._key(job_id)) > 0
+
+    async def list_jobs(self) -> list:
+        """Liste tous les jobs (SCAN, non bloquant pour Redis)"""
+        jobs = []
+        async for key in self.redis.scan_iter(match=f"{self.prefix}*"):
+            data = await self.redis.get(key)
+            if data is not None:
+                jobs.append(json.loads(data))
+        return jobs
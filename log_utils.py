@@ -0,0 +1,24 @@
+"""
+Suivi des logs d'entraînement partagé par les backends
+"""
+import asyncio
+from pathlib import Path
+from typing import AsyncIterator
+
+import aiofiles
+
+
+async def iter_log(log_path: Path, done: asyncio.Future) -> AsyncIterator[bytes]:
+    """Blocs d'un log en cours d'écriture (comme `tail -f`) jusqu'à la fin de done"""
+    async with aiofiles.open(log_path, "rb") as f:
+        while True:
+            # Lu avant la lecture: tout ce qui a été écrit avant la fin est rendu
+            finished = done.done()
+            chunk = await f.read(64 * 1024)
+
+            if chunk:
+                yield chunk
+            elif finished:
+                break
+            else:
+                await asyncio.sleep(1)
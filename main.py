@@ -2,34 +2,65 @@
 Backend FastAPI pour génération 3D avec Nerfstudio sur RunPod RTX 4090
 """
 import os
+import re
+import time
 import uuid
 import asyncio
-import subprocess
 import shutil
 from pathlib import Path
 from typing import Optional
-from datetime import datetime
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import partial
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-import cv2
 import numpy as np
+import aiofiles
+from arq import create_pool
+from arq.connections import ArqRedis, RedisSettings
 
-# Configuration
-UPLOAD_DIR = Path("uploads")
-OUTPUT_DIR = Path("outputs")
-JOBS_DIR = Path("jobs")
-TEMP_DIR = Path("temp")
+from config import get_config
+from download_utils import file_download_response, resolve_download_path
+from job_store import RedisJobStore, format_job
+from log_utils import iter_log
+from video_utils import extract_frames, sniff_video_format, warmup_opencv
 
-for dir_path in [UPLOAD_DIR, OUTPUT_DIR, JOBS_DIR, TEMP_DIR]:
-    dir_path.mkdir(exist_ok=True)
+# Configuration (dossiers créés au démarrage de l'API et du worker)
+config = get_config()
+UPLOAD_DIR = config.UPLOAD_DIR
+OUTPUT_DIR = config.OUTPUT_DIR
+JOBS_DIR = config.JOBS_DIR
 
-# État des jobs en mémoire (en production, utiliser Redis)
-jobs_status = {}
+# Taille des blocs lus lors de l'upload
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
-app = FastAPI(title="3D Generation API", version="1.0.0")
+# Colonne "Step (% Done)" de ns-train, ex: "2500 (25.00%)"
+TRAIN_PROGRESS_RE = re.compile(r"^\s*(\d+)\s+\((\d+(?:\.\d+)?)%\)")
+
+# État des jobs dans Redis (partagé entre workers, survit aux redémarrages)
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+job_store = RedisJobStore(REDIS_URL)
+
+# File de jobs GPU (arq): l'API ne fait qu'enfiler, le worker exécute
+REDIS_SETTINGS = RedisSettings.from_dsn(REDIS_URL)
+QUEUE_NAME = "gen3d:nerfstudio"
+job_queue: Optional[ArqRedis] = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Création des dossiers et connexion à la file de jobs"""
+    global job_queue
+    config.create_directories()
+    job_queue = await create_pool(REDIS_SETTINGS, default_queue_name=QUEUE_NAME)
+    yield
+    await job_queue.close()
+
+
+app = FastAPI(title="3D Generation API", version="1.0.0", lifespan=lifespan)
 
 # CORS pour React Native
 app.add_middleware(
@@ -50,63 +81,55 @@ class JobStatus(BaseModel):
     error: Optional[str] = None
 
 
-def extract_frames_from_video(video_path: Path, output_dir: Path, target_frames: int = 50) -> int:
+async def track_training_log(job_id: str, log_path: Path, done: asyncio.Future):
     """
-    Extrait des frames d'une vidéo pour Nerfstudio
+    Suit le log stdout de ns-train (comme `tail -f`) jusqu'à la fin de done
     
-    Args:
-        video_path: Chemin vers la vidéo
-        output_dir: Dossier de sortie pour les frames
-        target_frames: Nombre de frames à extraire
-    
-    Returns:
-        Nombre de frames extraites
+    Met à jour la progression (40% -> 85%) à partir des étapes affichées.
     """
-    output_dir.mkdir(exist_ok=True)
+    last_progress = 40
     
-    cap = cv2.VideoCapture(str(video_path))
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    fps = cap.get(cv2.CAP_PROP_FPS)
+    async def report(line: bytes):
+        nonlocal last_progress
+        match = TRAIN_PROGRESS_RE.search(line.decode(errors="replace"))
+        if match:
+            progress = 40 + int(45 * float(match[2]) / 100)
+            if progress != last_progress:
+                last_progress = progress
+                await job_store.update(job_id, progress=progress)
     
-    # Calculer l'intervalle pour obtenir target_frames uniformément réparties
-    interval = max(1, total_frames // target_frames)
+    pending = b""
+    async for chunk in iter_log(log_path, done):
+        # La dernière ligne, peut-être en cours d'écriture, attend le bloc suivant
+        *lines, pending = (pending + chunk).split(b"\n")
+        for line in lines:
+            await report(line)
     
-    frame_count = 0
-    extracted_count = 0
-    
-    print(f"📹 Vidéo: {total_frames} frames à {fps} FPS")
-    print(f"🎯 Extraction: 1 frame tous les {interval} frames")
-    
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        
-        if frame_count % interval == 0:
-            # Sauvegarder la frame
-            frame_path = output_dir / f"frame_{extracted_count:04d}.jpg"
-            cv2.imwrite(str(frame_path), frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
-            extracted_count += 1
-            
-            if extracted_count >= target_frames:
-                break
-        
-        frame_count += 1
-    
-    cap.release()
-    print(f"✅ {extracted_count} frames extraites")
-    
-    return extracted_count
+    # Dernière ligne sans fin de ligne, écrite juste avant la sortie du process
+    if pending:
+        await report(pending)
+
+
+def read_log_tail(log_path: Path, lines: int = 50) -> str:
+    """Dernières lignes d'un fichier de log"""
+    with open(log_path, "r", errors="replace") as f:
+        return "".join(deque(f, maxlen=lines)).strip()
 
 
 async def process_3d_generation(job_id: str, video_path: Path):
     """
     Traitement asynchrone de la génération 3D avec Nerfstudio
     """
+    # Opérations bloquantes (extraction, disque) hors de la boucle d'événements du worker
+    loop = asyncio.get_running_loop()
+    
     try:
-        jobs_status[job_id]["status"] = "processing"
-        jobs_status[job_id]["message"] = "Extraction des frames..."
-        jobs_status[job_id]["progress"] = 10
+        await job_store.update(
+            job_id,
+            status="processing",
+            message="Extraction des frames...",
+            progress=10
+        )
         
         # Créer les dossiers pour ce job
         job_dir = JOBS_DIR / job_id
@@ -117,13 +140,21 @@ async def process_3d_generation(job_id: str, video_path: Path):
         output_dir.mkdir(parents=True, exist_ok=True)
         
         # Étape 1: Extraire les frames
-        num_frames = extract_frames_from_video(video_path, frames_dir, target_frames=50)
+        num_frames = await loop.run_in_executor(
+            None, partial(
+                extract_frames, video_path, frames_dir, target_frames=50, max_dim=config.FRAME_MAX_DIM,
+                jpeg_quality=config.FRAME_JPEG_QUALITY
+            )
+        )
         
         if num_frames < 10:
             raise Exception(f"Pas assez de frames extraites ({num_frames}). Vidéo trop courte?")
         
-        jobs_status[job_id]["progress"] = 20
-        jobs_status[job_id]["message"] = "Traitement COLMAP (structure from motion)..."
+        await job_store.update(
+            job_id,
+            progress=20,
+            message="Traitement COLMAP (structure from motion)..."
+        )
         
         # Étape 2: COLMAP pour estimer les poses de caméra
         colmap_cmd = [
@@ -148,8 +179,11 @@ async def process_3d_generation(job_id: str, video_path: Path):
             print(f"❌ COLMAP Error: {error_msg}")
             raise Exception(f"COLMAP processing failed: {error_msg}")
         
-        jobs_status[job_id]["progress"] = 40
-        jobs_status[job_id]["message"] = "Entraînement du modèle NeRF (Instant-NGP)..."
+        await job_store.update(
+            job_id,
+            progress=40,
+            message="Entraînement du modèle NeRF (Instant-NGP)..."
+        )
         
         # Étape 3: Entraînement Instant-NGP avec Nerfstudio
         train_cmd = [
@@ -163,33 +197,31 @@ async def process_3d_generation(job_id: str, video_path: Path):
         
         print(f"🔄 Entraînement NeRF: {' '.join(train_cmd)}")
         
-        process = await asyncio.create_subprocess_exec(
-            *train_cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
+        # Sorties redirigées vers des fichiers: pas de pipe à vider, RAM constante
+        stdout_log = job_dir / "train_stdout.log"
+        stderr_log = job_dir / "train_stderr.log"
         
-        # Simuler la progression pendant l'entraînement
-        progress = 40
-        while process.returncode is None:
-            await asyncio.sleep(5)
-            progress = min(progress + 5, 85)
-            jobs_status[job_id]["progress"] = progress
-            
-            try:
-                await asyncio.wait_for(process.wait(), timeout=0.1)
-            except asyncio.TimeoutError:
-                continue
+        with open(stdout_log, "wb") as log_out, open(stderr_log, "wb") as log_err:
+            process = await asyncio.create_subprocess_exec(
+                *train_cmd,
+                stdout=log_out,
+                stderr=log_err
+            )
         
-        stdout, stderr = await process.communicate()
+        done = asyncio.ensure_future(process.wait())
+        await track_training_log(job_id, stdout_log, done)
+        await done
         
         if process.returncode != 0:
-            error_msg = stderr.decode() if stderr else "Training failed"
+            error_msg = read_log_tail(stderr_log) or "Training failed"
             print(f"❌ Training Error: {error_msg}")
             raise Exception(f"NeRF training failed: {error_msg}")
         
-        jobs_status[job_id]["progress"] = 90
-        jobs_status[job_id]["message"] = "Export du modèle 3D..."
+        await job_store.update(
+            job_id,
+            progress=90,
+            message="Export du modèle 3D..."
+        )
         
         # Étape 4: Export en PLY
         # Trouver le dernier checkpoint
@@ -235,27 +267,58 @@ async def process_3d_generation(job_id: str, video_path: Path):
         final_ply = OUTPUT_DIR / f"{job_id}.ply"
         
         if ply_file != final_ply:
-            shutil.move(str(ply_file), str(final_ply))
+            await loop.run_in_executor(None, shutil.move, str(ply_file), str(final_ply))
         
         # Succès !
-        jobs_status[job_id]["status"] = "completed"
-        jobs_status[job_id]["progress"] = 100
-        jobs_status[job_id]["message"] = "Modèle 3D généré avec succès"
-        jobs_status[job_id]["download_url"] = f"/download/{job_id}.ply"
+        await job_store.update(
+            job_id,
+            status="completed",
+            progress=100,
+            message="Modèle 3D généré avec succès",
+            download_url=f"/download/{job_id}.ply"
+        )
         
         print(f"✅ Job {job_id} terminé avec succès")
         
         # Nettoyer les fichiers temporaires (garder seulement le PLY final)
-        shutil.rmtree(job_dir, ignore_errors=True)
-        if video_path.exists():
-            video_path.unlink()
+        await loop.run_in_executor(None, shutil.rmtree, str(job_dir), True)
+        await loop.run_in_executor(None, partial(video_path.unlink, missing_ok=True))
         
     except Exception as e:
         print(f"❌ Erreur job {job_id}: {str(e)}")
-        jobs_status[job_id]["status"] = "failed"
-        jobs_status[job_id]["message"] = "Échec de la génération"
-        jobs_status[job_id]["error"] = str(e)
-        jobs_status[job_id]["progress"] = 0
+        await job_store.update(
+            job_id,
+            status="failed",
+            message="Échec de la génération",
+            error=str(e),
+            progress=0
+        )
+
+
+async def run_3d_generation(ctx: dict, job_id: str, video_path: str):
+    """Tâche arq: exécute le pipeline dans le worker GPU"""
+    await process_3d_generation(job_id, Path(video_path))
+
+
+async def worker_startup(ctx: dict):
+    """Démarrage du worker: dossiers de travail et préchargement d'OpenCV"""
+    config.create_directories()
+    warmup_opencv()
+
+
+class WorkerSettings:
+    """
+    Worker GPU: `arq main.WorkerSettings`
+    
+    Un seul job à la fois par worker pour ne pas partager la VRAM;
+    lancer un worker par GPU (CUDA_VISIBLE_DEVICES) pour paralléliser.
+    """
+    functions = [run_3d_generation]
+    on_startup = worker_startup
+    redis_settings = REDIS_SETTINGS
+    queue_name = QUEUE_NAME
+    max_jobs = 1
+    job_timeout = 3600  # Le pipeline complet dépasse largement les 300 s par défaut
 
 
 @app.get("/")
@@ -270,11 +333,41 @@ async def root():
     }
 
 
+async def save_upload(upload: UploadFile, video_path: Path) -> int:
+    """
+    Copie l'upload sur disque par blocs (mémoire bornée à un bloc)
+    
+    Lève une HTTPException 415 avant toute écriture si le contenu n'est pas
+    une vidéo d'un format accepté (octets de signature, pas le Content-Type),
+    et 413 en supprimant le fichier partiel si la vidéo dépasse MAX_UPLOAD_SIZE_MB.
+    
+    Returns:
+        Taille de la vidéo en octets
+    """
+    chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+    
+    if sniff_video_format(chunk) not in config.ALLOWED_VIDEO_FORMATS:
+        raise HTTPException(415, "Le fichier doit être une vidéo (MP4, MOV ou AVI)")
+    
+    total = 0
+    
+    async with aiofiles.open(video_path, "wb") as f:
+        while chunk:
+            total += len(chunk)
+            if total > config.MAX_UPLOAD_SIZE_BYTES:
+                break
+            await f.write(chunk)
+            chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+    
+    if total > config.MAX_UPLOAD_SIZE_BYTES:
+        video_path.unlink(missing_ok=True)
+        raise HTTPException(413, f"Vidéo trop volumineuse (max {config.MAX_UPLOAD_SIZE_MB} MB)")
+    
+    return total
+
+
 @app.post("/generate-3d")
-async def generate_3d(
-    background_tasks: BackgroundTasks,
-    file: UploadFile = File(...)
-):
+async def generate_3d(file: UploadFile = File(...)):
     """
     Endpoint principal: Upload vidéo et démarre la génération 3D
     
@@ -282,36 +375,30 @@ async def generate_3d(
         job_id pour suivre la progression
     """
     try:
-        # Vérifier le type de fichier
-        if not file.content_type.startswith("video/"):
-            raise HTTPException(400, "Le fichier doit être une vidéo")
-        
         # Générer un job_id unique
-        job_id = str(uuid.uuid4())
+        job_id = uuid.uuid4().hex
         
         # Sauvegarder la vidéo
         video_path = UPLOAD_DIR / f"{job_id}.mp4"
         
-        with open(video_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+        file_size = await save_upload(file, video_path)
         
-        file_size_mb = len(content) / (1024 * 1024)
+        file_size_mb = file_size / (1024 * 1024)
         print(f"📥 Vidéo reçue: {file_size_mb:.2f} MB")
         
         # Initialiser le statut du job
-        jobs_status[job_id] = {
+        await job_store.set(job_id, {
             "job_id": job_id,
             "status": "queued",
             "message": "En attente de traitement...",
             "progress": 0,
-            "created_at": datetime.now().isoformat(),
+            "created_at_ns": time.time_ns(),
             "download_url": None,
             "error": None
-        }
+        })
         
-        # Lancer le traitement en arrière-plan
-        background_tasks.add_task(process_3d_generation, job_id, video_path)
+        # Envoyer le traitement au worker GPU
+        await job_queue.enqueue_job("run_3d_generation", job_id, str(video_path), _job_id=job_id)
         
         return {
             "success": True,
@@ -320,6 +407,8 @@ async def generate_3d(
             "estimated_time": "2-5 minutes"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ Erreur upload: {str(e)}")
         raise HTTPException(500, f"Erreur lors de l'upload: {str(e)}")
@@ -330,26 +419,37 @@ async def get_job_status(job_id: str):
     """
     Récupère le statut d'un job de génération
     """
-    if job_id not in jobs_status:
+    job = await job_store.get(job_id)
+    if job is None:
         raise HTTPException(404, "Job non trouvé")
     
-    return jobs_status[job_id]
+    return format_job(job)
+
+
+@app.get("/job-status/{job_id}/wait")
+async def wait_job_status(job_id: str, since: Optional[int] = None):
+    """
+    Long-poll: répond dès que la progression diffère de `since` (ou après ~25 s)
+    """
+    job = await job_store.wait(job_id, since)
+    if job is None:
+        raise HTTPException(404, "Job non trouvé")
+    
+    return format_job(job)
 
 
 @app.get("/download/{filename}")
-async def download_model(filename: str):
+async def download_model(filename: str, request: Request):
     """
     Télécharge un modèle 3D généré
     """
-    file_path = OUTPUT_DIR / filename
-    
-    if not file_path.exists():
-        raise HTTPException(404, "Fichier non trouvé")
+    file_path = resolve_download_path(OUTPUT_DIR, filename)
     
-    return FileResponse(
-        path=str(file_path),
-        media_type="application/octet-stream",
-        filename=filename
+    return file_download_response(
+        file_path,
+        range_header=request.headers.get("range"),
+        accel_prefix=config.X_ACCEL_REDIRECT_PREFIX,
+        if_range=request.headers.get("if-range")
     )
 
 
@@ -358,14 +458,14 @@ async def delete_job(job_id: str):
     """
     Supprime un job et ses fichiers associés
     """
-    if job_id in jobs_status:
+    if await job_store.get(job_id) is not None:
         # Supprimer les fichiers
         ply_file = OUTPUT_DIR / f"{job_id}.ply"
         if ply_file.exists():
             ply_file.unlink()
         
         # Supprimer du statut
-        del jobs_status[job_id]
+        await job_store.delete(job_id)
         
         return {"success": True, "message": "Job supprimé"}
     
@@ -377,9 +477,10 @@ async def list_jobs():
     """
     Liste tous les jobs
     """
+    jobs = [format_job(job) for job in await job_store.list_jobs()]
     return {
-        "jobs": list(jobs_status.values()),
-        "total": len(jobs_status)
+        "jobs": jobs,
+        "total": len(jobs)
     }
 
 
@@ -3,30 +3,56 @@ Backend FastAPI avec COLMAP uniquement (comme en local)
 Plus simple et plus stable que Gaussian Splatting
 """
 import os
+import time
 import uuid
 import asyncio
-import subprocess
 import shutil
 from pathlib import Path
 from typing import Optional
-from datetime import datetime
+from contextlib import asynccontextmanager
+from functools import partial
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-import cv2
+import aiofiles
+from arq import create_pool
+from arq.connections import ArqRedis, RedisSettings
 
-# Configuration
-UPLOAD_DIR = Path("uploads")
-OUTPUT_DIR = Path("outputs")
-JOBS_DIR = Path("jobs")
+from config import get_config
+from download_utils import file_download_response, resolve_download_path
+from job_store import RedisJobStore, format_job
+from video_utils import extract_frames, sniff_video_format, warmup_opencv
 
-for dir_path in [UPLOAD_DIR, OUTPUT_DIR, JOBS_DIR]:
-    dir_path.mkdir(exist_ok=True)
+# Configuration (dossiers créés au démarrage de l'API et du worker)
+config = get_config()
+UPLOAD_DIR = config.UPLOAD_DIR
+OUTPUT_DIR = config.OUTPUT_DIR
+JOBS_DIR = config.JOBS_DIR
 
-jobs_status = {}
+# Taille des blocs lus lors de l'upload
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
-app = FastAPI(title="3D COLMAP API", version="1.0.0")
+# État des jobs dans Redis (partagé entre workers, survit aux redémarrages)
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+job_store = RedisJobStore(REDIS_URL)
+
+# File de jobs GPU (arq): l'API ne fait qu'enfiler, le worker exécute
+REDIS_SETTINGS = RedisSettings.from_dsn(REDIS_URL)
+QUEUE_NAME = "gen3d:colmap"
+job_queue: Optional[ArqRedis] = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Création des dossiers et connexion à la file de jobs"""
+    global job_queue
+    config.create_directories()
+    job_queue = await create_pool(REDIS_SETTINGS, default_queue_name=QUEUE_NAME)
+    yield
+    await job_queue.close()
+
+
+app = FastAPI(title="3D COLMAP API", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -37,32 +63,69 @@ app.add_middleware(
 )
 
 
-def extract_frames_from_video(video_path: Path, output_dir: Path, fps: int = 3) -> int:
-    """Extrait des frames d'une vidéo"""
-    output_dir.mkdir(exist_ok=True)
+def build_matching_cmd(database_path: Path, num_frames: int) -> list:
+    """
+    Commande de matching COLMAP adaptée au nombre de frames
+    
+    - <= 30 frames: exhaustive (toutes les paires, peu coûteux)
+    - sinon: séquentiel sur les 10 frames voisines (O(n)), les frames d'une
+      vidéo se recouvrant dans l'ordre temporel
+    - > 150 frames avec un arbre de vocabulaire: vocab_tree_matcher
+    """
+    vocab_tree = config.COLMAP_VOCAB_TREE_PATH
+    if vocab_tree is not None and not vocab_tree.exists():
+        vocab_tree = None
     
-    cap = cv2.VideoCapture(str(video_path))
-    video_fps = cap.get(cv2.CAP_PROP_FPS)
-    frame_interval = max(1, int(video_fps / fps))
+    gpu_options = ["--SiftMatching.use_gpu", "1", "--SiftMatching.gpu_index", "0"]
     
-    frame_count = 0
-    saved_count = 0
+    if num_frames <= 30:
+        return ["colmap", "exhaustive_matcher", "--database_path", str(database_path)] + gpu_options
     
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        
-        if frame_count % frame_interval == 0:
-            frame_path = output_dir / f"frame_{saved_count:04d}.jpg"
-            cv2.imwrite(str(frame_path), frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
-            saved_count += 1
-        
-        frame_count += 1
+    if vocab_tree is not None and num_frames > 150:
+        return [
+            "colmap", "vocab_tree_matcher",
+            "--database_path", str(database_path),
+            "--VocabTreeMatching.vocab_tree_path", str(vocab_tree)
+        ] + gpu_options
+    
+    matching_cmd = [
+        "colmap", "sequential_matcher",
+        "--database_path", str(database_path),
+        "--SequentialMatching.overlap", "10"
+    ]
+    
+    # La détection de boucles a besoin de l'arbre de vocabulaire
+    if vocab_tree is not None:
+        matching_cmd += [
+            "--SequentialMatching.loop_detection", "1",
+            "--SequentialMatching.loop_detection_period", "10",
+            "--SequentialMatching.vocab_tree_path", str(vocab_tree)
+        ]
     
-    cap.release()
-    print(f"✅ {saved_count} frames extraites")
-    return saved_count
+    return matching_cmd + gpu_options
+
+
+async def run_colmap_step(name: str, cmd: list):
+    """
+    Lance une étape COLMAP sans bloquer la boucle d'événements du worker
+
+    Le process est tué si la tâche est annulée (job_timeout d'arq).
+    """
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    
+    if process.returncode != 0:
+        raise Exception(f"{name} failed: {stderr.decode(errors='replace')}")
 
 
 async def process_colmap(job_id: str, video_path: Path):
@@ -70,10 +133,16 @@ async def process_colmap(job_id: str, video_path: Path):
     Traitement avec COLMAP uniquement
     Simple et stable
     """
+    # Opérations bloquantes (extraction, disque) hors de la boucle d'événements du worker
+    loop = asyncio.get_running_loop()
+    
     try:
-        jobs_status[job_id]["status"] = "processing"
-        jobs_status[job_id]["message"] = "Extraction des frames..."
-        jobs_status[job_id]["progress"] = 10
+        await job_store.update(
+            job_id,
+            status="processing",
+            message="Extraction des frames...",
+            progress=10
+        )
         
         job_dir = JOBS_DIR / job_id
         images_dir = job_dir / "images"
@@ -84,13 +153,21 @@ async def process_colmap(job_id: str, video_path: Path):
         sparse_dir.mkdir(parents=True, exist_ok=True)
         
         # Étape 1: Extraire frames
-        num_frames = extract_frames_from_video(video_path, images_dir, fps=3)
+        num_frames = await loop.run_in_executor(
+            None, partial(
+                extract_frames, video_path, images_dir, target_fps=3, max_dim=config.FRAME_MAX_DIM,
+                jpeg_quality=config.FRAME_JPEG_QUALITY
+            )
+        )
         
         if num_frames < 10:
             raise Exception(f"Pas assez de frames: {num_frames}. Vidéo trop courte (minimum 5 secondes)")
         
-        jobs_status[job_id]["progress"] = 20
-        jobs_status[job_id]["message"] = "COLMAP: Feature extraction..."
+        await job_store.update(
+            job_id,
+            progress=20,
+            message="COLMAP: Feature extraction..."
+        )
         
         # Étape 2: COLMAP Feature Extraction
         print("🔄 COLMAP: Feature extraction")
@@ -99,29 +176,31 @@ async def process_colmap(job_id: str, video_path: Path):
             "--database_path", str(database_path),
             "--image_path", str(images_dir),
             "--ImageReader.single_camera", "1",
-            "--ImageReader.camera_model", "SIMPLE_RADIAL"
+            "--ImageReader.camera_model", "SIMPLE_RADIAL",
+            "--SiftExtraction.use_gpu", "1",
+            "--SiftExtraction.gpu_index", "0",
+            "--SiftExtraction.max_num_features", "8192"
         ]
         
-        result = subprocess.run(feature_cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise Exception(f"Feature extraction failed: {result.stderr}")
+        await run_colmap_step("Feature extraction", feature_cmd)
         
-        jobs_status[job_id]["progress"] = 40
-        jobs_status[job_id]["message"] = "COLMAP: Feature matching..."
+        await job_store.update(
+            job_id,
+            progress=40,
+            message="COLMAP: Feature matching..."
+        )
         
         # Étape 3: COLMAP Feature Matching
-        print("🔄 COLMAP: Feature matching")
-        matching_cmd = [
-            "colmap", "exhaustive_matcher",
-            "--database_path", str(database_path)
-        ]
+        matching_cmd = build_matching_cmd(database_path, num_frames)
+        print(f"🔄 COLMAP: Feature matching ({matching_cmd[1]})")
         
-        result = subprocess.run(matching_cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise Exception(f"Feature matching failed: {result.stderr}")
+        await run_colmap_step("Feature matching", matching_cmd)
         
-        jobs_status[job_id]["progress"] = 60
-        jobs_status[job_id]["message"] = "COLMAP: Reconstruction 3D..."
+        await job_store.update(
+            job_id,
+            progress=60,
+            message="COLMAP: Reconstruction 3D..."
+        )
         
         # Étape 4: COLMAP Mapper (Reconstruction)
         print("🔄 COLMAP: Mapper")
@@ -132,12 +211,13 @@ async def process_colmap(job_id: str, video_path: Path):
             "--output_path", str(sparse_dir)
         ]
         
-        result = subprocess.run(mapper_cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise Exception(f"Mapper failed: {result.stderr}")
+        await run_colmap_step("Mapper", mapper_cmd)
         
-        jobs_status[job_id]["progress"] = 80
-        jobs_status[job_id]["message"] = "Export du modèle 3D..."
+        await job_store.update(
+            job_id,
+            progress=80,
+            message="Export du modèle 3D..."
+        )
         
         # Étape 5: Export PLY
         print("🔄 Export PLY")
@@ -155,26 +235,55 @@ async def process_colmap(job_id: str, video_path: Path):
             "--output_type", "PLY"
         ]
         
-        result = subprocess.run(export_cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise Exception(f"Export failed: {result.stderr}")
+        await run_colmap_step("Export", export_cmd)
         
-        # Nettoyage
-        video_path.unlink(missing_ok=True)
-        shutil.rmtree(job_dir, ignore_errors=True)
+        # Nettoyage hors de la boucle d'événements (milliers de fichiers COLMAP)
+        await loop.run_in_executor(None, partial(video_path.unlink, missing_ok=True))
+        await loop.run_in_executor(None, shutil.rmtree, str(job_dir), True)
         
-        jobs_status[job_id]["status"] = "completed"
-        jobs_status[job_id]["message"] = "Modèle 3D généré !"
-        jobs_status[job_id]["progress"] = 100
-        jobs_status[job_id]["download_url"] = f"/download/{job_id}.ply"
+        await job_store.update(
+            job_id,
+            status="completed",
+            message="Modèle 3D généré !",
+            progress=100,
+            download_url=f"/download/{job_id}.ply"
+        )
         
         print(f"✅ Job {job_id} terminé")
         
     except Exception as e:
         print(f"❌ Erreur job {job_id}: {str(e)}")
-        jobs_status[job_id]["status"] = "failed"
-        jobs_status[job_id]["message"] = f"Erreur: {str(e)}"
-        jobs_status[job_id]["error"] = str(e)
+        await job_store.update(
+            job_id,
+            status="failed",
+            message=f"Erreur: {str(e)}",
+            error=str(e)
+        )
+
+
+async def run_colmap(ctx: dict, job_id: str, video_path: str):
+    """Tâche arq: exécute COLMAP dans le worker GPU"""
+    await process_colmap(job_id, Path(video_path))
+
+
+async def worker_startup(ctx: dict):
+    """Démarrage du worker: dossiers de travail et préchargement d'OpenCV"""
+    config.create_directories()
+    warmup_opencv()
+
+
+class WorkerSettings:
+    """
+    Worker GPU: `arq main_colmap.WorkerSettings`
+    
+    Un seul job à la fois par worker, un worker par GPU.
+    """
+    functions = [run_colmap]
+    on_startup = worker_startup
+    redis_settings = REDIS_SETTINGS
+    queue_name = QUEUE_NAME
+    max_jobs = 1
+    job_timeout = 3600
 
 
 @app.get("/")
@@ -188,36 +297,64 @@ async def root():
     }
 
 
+async def save_upload(upload: UploadFile, video_path: Path) -> int:
+    """
+    Copie l'upload sur disque par blocs (mémoire bornée à un bloc)
+    
+    Lève une HTTPException 415 avant toute écriture si le contenu n'est pas
+    une vidéo d'un format accepté (octets de signature, pas le Content-Type),
+    et 413 en supprimant le fichier partiel si la vidéo dépasse MAX_UPLOAD_SIZE_MB.
+    
+    Returns:
+        Taille de la vidéo en octets
+    """
+    chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+    
+    if sniff_video_format(chunk) not in config.ALLOWED_VIDEO_FORMATS:
+        raise HTTPException(status_code=415, detail="Le fichier doit être une vidéo (MP4, MOV ou AVI)")
+    
+    total = 0
+    
+    async with aiofiles.open(video_path, "wb") as f:
+        while chunk:
+            total += len(chunk)
+            if total > config.MAX_UPLOAD_SIZE_BYTES:
+                break
+            await f.write(chunk)
+            chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+    
+    if total > config.MAX_UPLOAD_SIZE_BYTES:
+        video_path.unlink(missing_ok=True)
+        raise HTTPException(status_code=413, detail=f"Vidéo trop volumineuse (max {config.MAX_UPLOAD_SIZE_MB} MB)")
+    
+    return total
+
+
 @app.post("/generate-3d")
-async def generate_3d(
-    background_tasks: BackgroundTasks,
-    video: UploadFile = File(...)
-):
+async def generate_3d(video: UploadFile = File(...)):
     """Upload vidéo et démarre la génération 3D"""
     
     # Générer un ID unique
-    job_id = str(uuid.uuid4())
+    job_id = uuid.uuid4().hex
     
     # Sauvegarder la vidéo
     video_path = UPLOAD_DIR / f"{job_id}.mp4"
     
-    with open(video_path, "wb") as f:
-        content = await video.read()
-        f.write(content)
+    await save_upload(video, video_path)
     
     # Initialiser le statut
-    jobs_status[job_id] = {
+    await job_store.set(job_id, {
         "job_id": job_id,
         "status": "queued",
         "message": "En attente...",
         "progress": 0,
-        "created_at": datetime.now().isoformat(),
+        "created_at_ns": time.time_ns(),
         "download_url": None,
         "error": None
-    }
+    })
     
-    # Lancer le traitement en arrière-plan
-    background_tasks.add_task(process_colmap, job_id, video_path)
+    # Envoyer le traitement au worker GPU
+    await job_queue.enqueue_job("run_colmap", job_id, str(video_path), _job_id=job_id)
     
     return {
         "success": True,
@@ -230,45 +367,54 @@ async def generate_3d(
 @app.get("/job-status/{job_id}")
 async def get_job_status(job_id: str):
     """Récupère le statut d'un job"""
-    if job_id not in jobs_status:
+    job = await job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job non trouvé")
+    
+    return format_job(job)
+
+
+@app.get("/job-status/{job_id}/wait")
+async def wait_job_status(job_id: str, since: Optional[int] = None):
+    """Long-poll: répond dès que la progression diffère de `since` (ou après ~25 s)"""
+    job = await job_store.wait(job_id, since)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job non trouvé")
     
-    return jobs_status[job_id]
+    return format_job(job)
 
 
 @app.get("/download/{filename}")
-async def download_model(filename: str):
+async def download_model(filename: str, request: Request):
     """Télécharge un modèle 3D"""
-    file_path = OUTPUT_DIR / filename
-    
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="Fichier non trouvé")
+    file_path = resolve_download_path(OUTPUT_DIR, filename)
     
-    return FileResponse(
-        path=file_path,
-        media_type="application/octet-stream",
-        filename=filename
+    return file_download_response(
+        file_path,
+        range_header=request.headers.get("range"),
+        accel_prefix=config.X_ACCEL_REDIRECT_PREFIX,
+        if_range=request.headers.get("if-range")
     )
 
 
 @app.get("/jobs")
 async def list_jobs():
     """Liste tous les jobs"""
-    return {"jobs": list(jobs_status.values())}
+    return {"jobs": [format_job(job) for job in await job_store.list_jobs()]}
 
 
 @app.delete("/job/{job_id}")
 async def delete_job(job_id: str):
     """Supprime un job et ses fichiers"""
-    if job_id in jobs_status:
+    if await job_store.get(job_id) is not None:
         # Supprimer les fichiers
         output_file = OUTPUT_DIR / f"{job_id}.ply"
         output_file.unlink(missing_ok=True)
         
         job_dir = JOBS_DIR / job_id
-        shutil.rmtree(job_dir, ignore_errors=True)
+        await asyncio.get_running_loop().run_in_executor(None, shutil.rmtree, str(job_dir), True)
         
-        del jobs_status[job_id]
+        await job_store.delete(job_id)
         
         return {"success": True, "message": "Job supprimé"}
     
@@ -2,32 +2,175 @@
 Backend FastAPI avec 3D Gaussian Splatting (Alternative ultra-rapide)
 Utilise le repo officiel: https://github.com/graphdeco-inria/gaussian-splatting
 """
+import math
 import os
+import re
+import time
 import uuid
 import asyncio
 import subprocess
 import shutil
+import urllib.request
 from pathlib import Path
-from typing import Optional
-from datetime import datetime
+from typing import AsyncIterator, Optional
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import partial
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
-import cv2
+import aiofiles
+import numpy as np
+from plyfile import PlyData, PlyElement
+
+from config import get_config
+from download_utils import file_download_response, resolve_download_path, write_zstd_copy
+from gs_worker import CUDA_ALLOC_CONF, TrainingWorker
+from job_store import RedisJobStore, format_job
+from log_utils import iter_log
+from video_utils import extract_frames, probe_video, probe_video_duration
 
 # Configuration
+config = get_config()
 UPLOAD_DIR = Path("uploads")
 OUTPUT_DIR = Path("outputs")
 JOBS_DIR = Path("jobs")
-GAUSSIAN_SPLATTING_PATH = Path("/workspace/gaussian-splatting")  # À adapter
+GAUSSIAN_SPLATTING_PATH = config.GAUSSIAN_SPLATTING_PATH  # GAUSSIAN_SPLATTING_PATH dans .env
+
+# Frames limitées à 1600 px (au-delà, 3DGS redimensionne lui-même et la VRAM explose)
+FRAME_MAX_DIM = 1600
+FRAME_JPEG_QUALITY = 92
+
+# Cadence d'extraction, et nombre max de caméras pour COLMAP (matching et nuage
+# initial bornés sur les longues vidéos)
+FRAMES_FPS = 3
+MAX_FRAMES = 300
+
+# Densification limitée (seuil de gradient doublé, arrêt à DENSIFY_UNTIL_ITER):
+# borne le nombre de gaussiennes et la VRAM sur les longues vidéos
+DENSIFY_GRAD_THRESHOLD = 0.0004
+
+# Gaussiennes quasi invisibles retirées du PLY publié (sigmoid(opacité) < seuil, 0 = désactivé)
+PRUNE_MIN_OPACITY = 0.005
+
+# Messages PyTorch d'un manque de VRAM
+CUDA_OOM_MARKERS = ("CUDA out of memory", "OutOfMemoryError")
+
+# Vidéo minimale acceptée à l'upload (en dessous, COLMAP échoue après plusieurs minutes)
+MIN_VIDEO_DURATION = 5
+MIN_VIDEO_PIXELS = 480 * 270
+
+# Taille des blocs lus lors de l'upload
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Barre tqdm de train.py (stderr), ex: "Training progress:  42%|████▏     | 2940/7000 [00:30<00:41, ...]"
+TRAIN_PROGRESS_RE = re.compile(r"Training progress:\s+(\d+)%(?:.*?(\d+)/(\d+))?")
+
+# Nombre de mesures (itération, instant) pour la vitesse d'entraînement de l'ETA
+ETA_WINDOW = 20
+
+# Frames extraites en RAM (tmpfs): COLMAP les lit une fois, inutile de les écrire sur le SSD.
+# Le /dev/shm de Docker fait 64 MB par défaut: lancer le conteneur avec --shm-size=1g
+# (shm_size dans docker-compose), sinon les frames restent sur disque
+TMPFS_JOBS_DIR = Path("/dev/shm/gs_jobs")
+# Majorant de la taille d'une frame JPEG (1600 px, qualité 92)
+FRAME_SIZE_ESTIMATE = 1024 * 1024
+
+# Ressources COLMAP communes à tous les jobs (base vide modèle, arbre de vocabulaire)
+COLMAP_CACHE_DIR = JOBS_DIR / ".cache"
+TEMPLATE_DATABASE = COLMAP_CACHE_DIR / "database.db"
+# Délai max (s) sans réponse du serveur pendant le téléchargement de l'arbre de vocabulaire
+VOCAB_TREE_TIMEOUT = 60
 
 for dir_path in [UPLOAD_DIR, OUTPUT_DIR, JOBS_DIR]:
     dir_path.mkdir(exist_ok=True)
 
-jobs_status = {}
+# État des jobs dans Redis (partagé entre workers, survit aux redémarrages, expire après 24 h)
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+job_store = RedisJobStore(REDIS_URL)
+
+# Pipelines GPU simultanés: les jobs en trop restent "queued" jusqu'à libération
+GPU_SEM = asyncio.Semaphore(config.GPU_SLOTS)
+
+# train.py exécuté dans un process persistant (torch et CUDA chargés une fois),
+# ou un nouveau process par job si GS_PERSISTENT_WORKER=false. GPU_SEM et
+# trainer sont propres au process: ce backend tourne avec un seul worker uvicorn
+trainer: Optional[TrainingWorker] = None
+if config.GS_PERSISTENT_WORKER and config.WORKERS > 1:
+    print(f"⚠️ WORKERS={config.WORKERS}: worker d'entraînement persistant désactivé (un contexte CUDA par process)")
+elif config.GS_PERSISTENT_WORKER:
+    trainer = TrainingWorker(GAUSSIAN_SPLATTING_PATH)
+
 
-app = FastAPI(title="3D Gaussian Splatting API", version="1.0.0")
+def vocab_tree_path() -> Optional[Path]:
+    """Arbre de vocabulaire COLMAP: COLMAP_VOCAB_TREE_PATH, sinon la copie téléchargée en cache"""
+    if config.COLMAP_VOCAB_TREE_PATH is not None:
+        return config.COLMAP_VOCAB_TREE_PATH
+    if config.COLMAP_VOCAB_TREE_URL:
+        return COLMAP_CACHE_DIR / config.COLMAP_VOCAB_TREE_URL.rsplit("/", 1)[-1]
+    return None
+
+
+def prepare_colmap_cache():
+    """
+    Prépare une fois pour toutes la base COLMAP vide et l'arbre de vocabulaire
+    
+    Les fichiers sont écrits sous un nom temporaire propre au process (plusieurs
+    workers uvicorn peuvent s'en charger en même temps) puis renommés: leur
+    présence suffit à savoir qu'ils sont complets.
+    """
+    # Exécuté sans attente du résultat (lifespan): toute erreur est journalisée ici
+    if not TEMPLATE_DATABASE.exists() and shutil.which("colmap"):
+        tmp_path = COLMAP_CACHE_DIR / f".database.db.{os.getpid()}.tmp"
+        try:
+            COLMAP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            result = subprocess.run(
+                ["colmap", "database_creator", "--database_path", str(tmp_path)],
+                capture_output=True, text=True
+            )
+            if result.returncode != 0:
+                raise Exception(result.stderr.strip())
+            os.replace(tmp_path, TEMPLATE_DATABASE)
+        except Exception as e:
+            print(f"⚠️ Base COLMAP modèle non créée: {e}")
+            tmp_path.unlink(missing_ok=True)
+    
+    vocab_tree = vocab_tree_path()
+    if config.COLMAP_VOCAB_TREE_PATH is None and vocab_tree is not None and not vocab_tree.exists():
+        print(f"📥 Téléchargement de l'arbre de vocabulaire: {config.COLMAP_VOCAB_TREE_URL}")
+        tmp_path = vocab_tree.with_name(f".{vocab_tree.name}.{os.getpid()}.tmp")
+        try:
+            COLMAP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            with urllib.request.urlopen(config.COLMAP_VOCAB_TREE_URL, timeout=VOCAB_TREE_TIMEOUT) as response:
+                with open(tmp_path, "wb") as f:
+                    shutil.copyfileobj(response, f)
+            os.replace(tmp_path, vocab_tree)
+        except Exception as e:
+            print(f"⚠️ Arbre de vocabulaire indisponible, matching sans détection de boucles: {e}")
+            tmp_path.unlink(missing_ok=True)
+
+
+def log_cache_error(future: asyncio.Future):
+    """Journalise une erreur imprévue de prepare_colmap_cache (son résultat n'est pas attendu)"""
+    if not future.cancelled() and future.exception() is not None:
+        print(f"⚠️ Cache COLMAP non préparé: {future.exception()}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Démarrage du worker d'entraînement et préparation du cache COLMAP avec l'API"""
+    if trainer is not None:
+        trainer.start()
+    
+    # En arrière-plan: les jobs démarrés avant la fin s'en passent
+    cache_future = asyncio.get_running_loop().run_in_executor(None, prepare_colmap_cache)
+    cache_future.add_done_callback(log_cache_error)
+    yield
+    if trainer is not None:
+        await asyncio.get_running_loop().run_in_executor(None, trainer.stop)
+
+
+app = FastAPI(title="3D Gaussian Splatting API", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -38,154 +181,399 @@ app.add_middleware(
 )
 
 
-def extract_frames_from_video(video_path: Path, output_dir: Path, fps: int = 2) -> int:
-    """Extrait des frames d'une vidéo à un FPS donné"""
-    output_dir.mkdir(exist_ok=True)
-    
-    cap = cv2.VideoCapture(str(video_path))
-    video_fps = cap.get(cv2.CAP_PROP_FPS)
-    frame_interval = int(video_fps / fps)
+async def iter_stream(stream: asyncio.StreamReader) -> AsyncIterator[bytes]:
+    """Blocs d'une sortie de process jusqu'à sa fermeture"""
+    while chunk := await stream.read(64 * 1024):
+        yield chunk
+
+
+async def read_training_output(job_id: str, chunks: AsyncIterator[bytes], tail: Optional[deque] = None):
+    """
+    Lit une sortie de train.py jusqu'à sa fin
     
-    frame_count = 0
-    saved_count = 0
+    tqdm réécrit sa ligne avec \r: le flux est découpé sur \r et \n pour
+    suivre la progression (40% -> 85%). Les autres lignes sont gardées dans
+    tail pour le message d'erreur.
+    """
+    last_progress = 40
+    samples = deque(maxlen=ETA_WINDOW)
+    pending = b""
     
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-        
-        if frame_count % frame_interval == 0:
-            frame_path = output_dir / f"{saved_count:04d}.jpg"
-            cv2.imwrite(str(frame_path), frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
-            saved_count += 1
+    async for chunk in chunks:
+        *lines, pending = re.split(rb"[\r\n]", pending + chunk)
         
-        frame_count += 1
+        for raw_line in lines:
+            line = raw_line.decode(errors="replace").strip()
+            if not line:
+                continue
+            
+            match = TRAIN_PROGRESS_RE.search(line)
+            if not match:
+                if tail is not None:
+                    tail.append(line)
+                continue
+            
+            if match[2] is None:
+                progress = 40 + int(0.45 * int(match[1]))
+                fields = {}
+            else:
+                iteration, total = int(match[2]), int(match[3])
+                progress = 40 + int(45 * iteration / max(total, 1))
+                
+                # ETA sur la vitesse récente (moyenne glissante des dernières mesures).
+                # Une mesure par seconde au plus: un log suivi arrive par paquets
+                now = time.monotonic()
+                if not samples or now - samples[-1][1] >= 1:
+                    samples.append((iteration, now))
+                first_iteration, first_time = samples[0]
+                last_iteration, last_time = samples[-1]
+                elapsed = last_time - first_time
+                rate = (last_iteration - first_iteration) / elapsed if elapsed > 0 else 0
+                fields = {"eta_seconds": round((total - iteration) / rate) if rate > 0 else None}
+            
+            if progress != last_progress:
+                last_progress = progress
+                await job_store.update(job_id, progress=progress, **fields)
+    
+    if pending.strip() and tail is not None:
+        tail.append(pending.decode(errors="replace").strip())
+
+
+def prune_gaussians(ply_path: Path, min_opacity: float) -> Path:
+    """
+    Retire les gaussiennes quasi transparentes d'un PLY 3DGS
+    
+    Le format (champs float32, ordre des propriétés) est conservé pour rester
+    lisible par les viewers Gaussian Splatting.
+    
+    Returns:
+        Chemin du PLY élagué (à côté de l'original)
+    """
+    vertices = PlyData.read(str(ply_path))["vertex"].data
+    
+    # train.py stocke l'opacité avant sigmoïde: comparer au logit du seuil
+    keep = vertices["opacity"] >= np.log(min_opacity / (1 - min_opacity))
+    
+    pruned_path = ply_path.with_name(f"{ply_path.stem}_pruned.ply")
+    PlyData([PlyElement.describe(vertices[keep], "vertex")]).write(str(pruned_path))
+    
+    print(f"✂️ Gaussiennes: {int(keep.sum())}/{len(vertices)} conservées (opacité >= {min_opacity})")
+    return pruned_path
+
+
+def frames_dir(job_id: str, job_dir: Path, frame_budget: int) -> Path:
+    """
+    Dossier des frames du job: sur tmpfs s'il reste la place pour ses
+    frame_budget frames, sinon dans job_dir
+
+    Simple constat de la place libre (rien n'est réservé): si tmpfs se
+    remplit pendant l'extraction, run_gaussian_splatting la reprend sur disque.
+    """
+    needed = frame_budget * FRAME_SIZE_ESTIMATE
+    try:
+        if shutil.disk_usage(TMPFS_JOBS_DIR.parent).free >= needed:
+            return TMPFS_JOBS_DIR / job_id / "input"
+    except OSError:
+        pass  # Pas de /dev/shm (macOS, conteneur sans tmpfs)
+    return job_dir / "input"
+
+
+async def run_colmap_step(name: str, cmd: list):
+    """Lance une étape COLMAP sans bloquer la boucle d'événements"""
+    print(f"🔄 COLMAP {name}: {' '.join(cmd)}")
+    
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    
+    stdout, stderr = await process.communicate()
     
-    cap.release()
-    print(f"✅ {saved_count} frames extraites")
-    return saved_count
+    if process.returncode != 0:
+        raise Exception(f"COLMAP {name} failed: {stderr.decode(errors='replace')}")
+
+
+async def run_training(job_id: str, train_cmd: list, log_path: Path) -> tuple:
+    """
+    Lance train.py et suit sa progression jusqu'à la fin
+    
+    Dans le worker persistant, la sortie passe par log_path (suivi comme
+    `tail -f`); sinon par les pipes du process.
+    
+    Returns:
+        (code de retour, dernières lignes de la sortie d'erreur)
+    """
+    print(f"🔄 Training: {' '.join(train_cmd)}")
+    
+    stderr_tail = deque(maxlen=50)
+    
+    if trainer is not None:
+        log_path.write_bytes(b"")
+        result = asyncio.ensure_future(trainer.train(train_cmd[2:], log_path))
+        await read_training_output(job_id, iter_log(log_path, result), stderr_tail)
+        return await result, stderr_tail
+    
+    env = dict(os.environ)
+    env.setdefault("PYTORCH_CUDA_ALLOC_CONF", CUDA_ALLOC_CONF)
+    
+    process = await asyncio.create_subprocess_exec(
+        *train_cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        cwd=str(GAUSSIAN_SPLATTING_PATH),
+        env=env
+    )
+    
+    # Progression lue en continu sur stdout et stderr (aucun tampon plein ne bloque l'entraînement)
+    await asyncio.gather(
+        read_training_output(job_id, iter_stream(process.stdout)),
+        read_training_output(job_id, iter_stream(process.stderr), stderr_tail)
+    )
+    await process.wait()
+    
+    return process.returncode, stderr_tail
 
 
 async def process_gaussian_splatting(job_id: str, video_path: Path):
     """
     Traitement avec 3D Gaussian Splatting
     Beaucoup plus rapide que NeRF: ~1-2 minutes sur RTX 4090
+    
+    Attend un slot GPU (GPU_SLOTS) avant de démarrer.
     """
+    async with GPU_SEM:
+        await run_gaussian_splatting(job_id, video_path)
+
+
+async def run_gaussian_splatting(job_id: str, video_path: Path):
+    """Pipeline complet d'un job: frames, COLMAP, entraînement, export"""
+    # Opérations disque lourdes hors de la boucle d'événements
+    loop = asyncio.get_running_loop()
+    
+    # Chemins absolus: train.py s'exécute depuis GAUSSIAN_SPLATTING_PATH (cwd du
+    # subprocess, chdir du worker persistant)
+    job_dir = (JOBS_DIR / job_id).resolve()
+    input_dir = job_dir / "input"
+    output_dir = job_dir / "output"
+    
     try:
-        jobs_status[job_id]["status"] = "processing"
-        jobs_status[job_id]["message"] = "Extraction des frames..."
-        jobs_status[job_id]["progress"] = 10
-        
-        job_dir = JOBS_DIR / job_id
-        input_dir = job_dir / "input"
-        output_dir = job_dir / "output"
+        await job_store.update(
+            job_id,
+            status="processing",
+            message=f"Extraction des frames (max {FRAME_MAX_DIM} px, JPEG {FRAME_JPEG_QUALITY})...",
+            progress=10
+        )
         
-        input_dir.mkdir(parents=True, exist_ok=True)
         output_dir.mkdir(parents=True, exist_ok=True)
         
-        # Étape 1: Extraire frames (augmenté à 3 FPS pour vidéos courtes)
-        num_frames = extract_frames_from_video(video_path, input_dir, fps=3)
+        # Frames attendues pour ce job: dimensionne la place demandée à tmpfs
+        duration = 0.0
+        if shutil.which("ffprobe"):
+            duration = await loop.run_in_executor(None, probe_video_duration, video_path)
+        frame_budget = min(MAX_FRAMES, math.ceil(duration * FRAMES_FPS)) if duration else MAX_FRAMES
+        input_dir = frames_dir(job_id, job_dir, frame_budget)
+        
+        # Étape 1: Extraire frames (augmenté à 3 FPS pour vidéos courtes, au plus
+        # MAX_FRAMES réparties sur toute la vidéo pour les longues)
+        # FFmpeg (NVDEC si disponible) dans un thread: la boucle d'événements reste libre
+        extract = partial(
+            extract_frames, video_path, target_fps=FRAMES_FPS, target_frames=MAX_FRAMES,
+            max_dim=FRAME_MAX_DIM, jpeg_quality=FRAME_JPEG_QUALITY
+        )
+        try:
+            num_frames = await loop.run_in_executor(None, extract, input_dir)
+        except Exception as e:
+            if not input_dir.is_relative_to(TMPFS_JOBS_DIR):
+                raise
+            # tmpfs rempli entre-temps (autres jobs, autres process): extraction reprise sur disque
+            print(f"⚠️ Extraction en RAM échouée, reprise sur disque: {e}")
+            await loop.run_in_executor(None, shutil.rmtree, str(input_dir.parent), True)
+            input_dir = job_dir / "input"
+            num_frames = await loop.run_in_executor(None, extract, input_dir)
         
         if num_frames < 10:
             raise Exception(f"Pas assez de frames: {num_frames}. Vidéo trop courte (minimum 5 secondes)")
         
-        jobs_status[job_id]["progress"] = 20
-        jobs_status[job_id]["message"] = "COLMAP: Structure from Motion..."
+        frames_note = f" ({num_frames} frames, limite de {MAX_FRAMES} atteinte)" if num_frames >= MAX_FRAMES else ""
+        if frames_note:
+            print(f"✂️ Vidéo longue: frames sous-échantillonnées{frames_note}")
         
-        # Étape 2: COLMAP pour les poses de caméra
-        colmap_script = GAUSSIAN_SPLATTING_PATH / "convert.py"
+        await job_store.update(
+            job_id,
+            progress=20,
+            message=f"COLMAP: Structure from Motion...{frames_note}"
+        )
         
-        colmap_cmd = [
-            "python", str(colmap_script),
-            "-s", str(job_dir),
-            "--skip_matching"  # Plus rapide, utilise l'ordre séquentiel
+        # Étape 2: COLMAP pour les poses de caméra (équivalent de convert.py, matching séquentiel)
+        distorted_dir = job_dir / "distorted"
+        distorted_sparse_dir = distorted_dir / "sparse"
+        database_path = distorted_dir / "database.db"
+        distorted_sparse_dir.mkdir(parents=True, exist_ok=True)
+        
+        # Base vide copiée (et non liée: COLMAP écrit dedans) plutôt que créée à chaque job
+        if TEMPLATE_DATABASE.exists():
+            await loop.run_in_executor(None, shutil.copyfile, TEMPLATE_DATABASE, database_path)
+        
+        await run_colmap_step("feature_extractor", [
+            "colmap", "feature_extractor",
+            "--database_path", str(database_path),
+            "--image_path", str(input_dir),
+            "--ImageReader.single_camera", "1",
+            "--ImageReader.camera_model", "OPENCV",
+            "--SiftExtraction.use_gpu", "1",
+            "--SiftExtraction.max_image_size", str(FRAME_MAX_DIM)
+        ])
+        
+        await job_store.update(job_id, progress=25)
+        
+        # Frames consécutives d'une vidéo: matching avec les 10 voisines (O(n))
+        matching_cmd = [
+            "colmap", "sequential_matcher",
+            "--database_path", str(database_path),
+            "--SequentialMatching.overlap", "10",
+            "--SiftMatching.use_gpu", "1"
         ]
         
-        print(f"🔄 COLMAP: {' '.join(colmap_cmd)}")
-        
-        process = await asyncio.create_subprocess_exec(
-            *colmap_cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            cwd=str(GAUSSIAN_SPLATTING_PATH)
+        # Détection de boucles (retour sur une zone déjà filmée) avec l'arbre de vocabulaire
+        vocab_tree = vocab_tree_path()
+        if vocab_tree is not None and vocab_tree.exists():
+            matching_cmd += [
+                "--SequentialMatching.loop_detection", "1",
+                "--SequentialMatching.loop_detection_period", "10",
+                "--SequentialMatching.vocab_tree_path", str(vocab_tree)
+            ]
+        
+        await run_colmap_step("sequential_matcher", matching_cmd)
+        
+        await job_store.update(job_id, progress=30)
+        
+        await run_colmap_step("mapper", [
+            "colmap", "mapper",
+            "--database_path", str(database_path),
+            "--image_path", str(input_dir),
+            "--output_path", str(distorted_sparse_dir),
+            "--Mapper.ba_global_function_tolerance", "0.000001"
+        ])
+        
+        if not (distorted_sparse_dir / "0").is_dir():
+            raise Exception("COLMAP n'a reconstruit aucun modèle (vidéo trop floue ou sans mouvement?)")
+        
+        # Images et caméras sans distorsion (PINHOLE) attendues par train.py
+        await run_colmap_step("image_undistorter", [
+            "colmap", "image_undistorter",
+            "--image_path", str(input_dir),
+            "--input_path", str(distorted_sparse_dir / "0"),
+            "--output_path", str(job_dir),
+            "--output_type", "COLMAP"
+        ])
+        
+        # Frames d'origine inutiles après undistortion: tmpfs libéré avant l'entraînement
+        if input_dir.is_relative_to(TMPFS_JOBS_DIR):
+            await loop.run_in_executor(None, shutil.rmtree, str(input_dir.parent), True)
+        
+        # train.py lit le modèle dans sparse/0
+        sparse_dir = job_dir / "sparse"
+        (sparse_dir / "0").mkdir(exist_ok=True)
+        for model_file in sparse_dir.iterdir():
+            if model_file.is_file():
+                model_file.rename(sparse_dir / "0" / model_file.name)
+        
+        await job_store.update(
+            job_id,
+            progress=40,
+            message="Entraînement Gaussian Splatting..."
         )
         
-        stdout, stderr = await process.communicate()
-        
-        if process.returncode != 0:
-            raise Exception(f"COLMAP failed: {stderr.decode()}")
-        
-        jobs_status[job_id]["progress"] = 40
-        jobs_status[job_id]["message"] = "Entraînement Gaussian Splatting..."
-        
         # Étape 3: Entraînement Gaussian Splatting
         train_cmd = [
             "python", "train.py",
             "-s", str(job_dir),
             "-m", str(output_dir),
-            "--iterations", "7000",  # ~1-2 min sur RTX 4090
-            "--test_iterations", "7000",
-            "--save_iterations", "7000",
+            "--iterations", str(config.ITERATIONS),  # 7000 par défaut: ~1-2 min sur RTX 4090
+            "--test_iterations", str(config.ITERATIONS),
+            "--save_iterations", str(config.ITERATIONS),
+            "--data_device", "cpu",  # Images d'entraînement en RAM, envoyées au GPU à chaque itération
+            "--densify_grad_threshold", str(DENSIFY_GRAD_THRESHOLD),
+            "--densify_until_iter", str(config.DENSIFY_UNTIL_ITER),
+            "--densification_interval", str(config.DENSIFICATION_INTERVAL),
             "--quiet"
         ]
         
-        print(f"🔄 Training: {' '.join(train_cmd)}")
-        
-        process = await asyncio.create_subprocess_exec(
-            *train_cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            cwd=str(GAUSSIAN_SPLATTING_PATH)
+        train_log = job_dir / "train.log"
+        returncode, stderr_tail = await run_training(job_id, train_cmd, train_log)
+        
+        if returncode != 0 and any(marker in line for line in stderr_tail for marker in CUDA_OOM_MARKERS):
+            # VRAM insuffisante: un seul nouvel essai à mi-résolution
+            print("⚠️ CUDA out of memory, nouvel essai à mi-résolution (-r 2)")
+            await job_store.update(
+                job_id,
+                progress=40,
+                message="Entraînement Gaussian Splatting (mi-résolution)..."
+            )
+            returncode, stderr_tail = await run_training(job_id, train_cmd + ["-r", "2"], train_log)
+        
+        if returncode != 0:
+            raise Exception("Training failed: " + "\n".join(stderr_tail))
+        
+        await job_store.update(
+            job_id,
+            progress=90,
+            message="Export du modèle PLY...",
+            eta_seconds=None
         )
         
-        # Progression pendant l'entraînement
-        progress = 40
-        while process.returncode is None:
-            await asyncio.sleep(3)
-            progress = min(progress + 5, 85)
-            jobs_status[job_id]["progress"] = progress
-            
-            try:
-                await asyncio.wait_for(process.wait(), timeout=0.1)
-            except asyncio.TimeoutError:
-                continue
-        
-        stdout, stderr = await process.communicate()
-        
-        if process.returncode != 0:
-            raise Exception(f"Training failed: {stderr.decode()}")
-        
-        jobs_status[job_id]["progress"] = 90
-        jobs_status[job_id]["message"] = "Export du modèle PLY..."
-        
         # Étape 4: Le modèle PLY est déjà généré par Gaussian Splatting
-        ply_source = output_dir / "point_cloud" / "iteration_7000" / "point_cloud.ply"
+        ply_source = output_dir / "point_cloud" / f"iteration_{config.ITERATIONS}" / "point_cloud.ply"
         
         if not ply_source.exists():
             raise Exception("Fichier PLY non trouvé après l'entraînement")
         
-        # Copier vers le dossier de sortie
+        if PRUNE_MIN_OPACITY > 0:
+            ply_source = await loop.run_in_executor(None, prune_gaussians, ply_source, PRUNE_MIN_OPACITY)
+        
+        # Publier sans recopier le PLY: lien physique, sinon déplacement (job_dir est supprimé ensuite)
         ply_final = OUTPUT_DIR / f"{job_id}.ply"
-        shutil.copy(str(ply_source), str(ply_final))
+        try:
+            os.link(ply_source, ply_final)
+        except OSError:
+            await loop.run_in_executor(None, shutil.move, str(ply_source), str(ply_final))
+        
+        # Copie zstd pour /download, avant de marquer le job terminé. Simple
+        # optimisation: le PLY publié reste servi tel quel si elle échoue
+        try:
+            await loop.run_in_executor(None, write_zstd_copy, ply_final)
+        except Exception as e:
+            print(f"⚠️ Copie zstd non créée pour {ply_final.name}: {e}")
         
         # Succès
-        jobs_status[job_id]["status"] = "completed"
-        jobs_status[job_id]["progress"] = 100
-        jobs_status[job_id]["message"] = "Modèle 3D généré avec succès"
-        jobs_status[job_id]["download_url"] = f"/download/{job_id}.ply"
+        await job_store.update(
+            job_id,
+            status="completed",
+            progress=100,
+            message="Modèle 3D généré avec succès",
+            download_url=f"/download/{job_id}.ply"
+        )
         
         print(f"✅ Job {job_id} terminé")
         
-        # Nettoyer
-        shutil.rmtree(job_dir, ignore_errors=True)
-        if video_path.exists():
-            video_path.unlink()
+        # Nettoyer (milliers de JPEG et fichiers COLMAP: /job-status reste réactif)
+        await loop.run_in_executor(None, shutil.rmtree, str(job_dir), True)
+        await loop.run_in_executor(None, partial(video_path.unlink, missing_ok=True))
         
     except Exception as e:
         print(f"❌ Erreur job {job_id}: {str(e)}")
-        jobs_status[job_id]["status"] = "failed"
-        jobs_status[job_id]["message"] = "Échec de la génération"
-        jobs_status[job_id]["error"] = str(e)
+        await job_store.update(
+            job_id,
+            status="failed",
+            message="Échec de la génération",
+            error=str(e)
+        )
+    
+    finally:
+        # job_dir reste sur disque après un échec (diagnostic), mais pas les frames en RAM
+        if input_dir.is_relative_to(TMPFS_JOBS_DIR):
+            await loop.run_in_executor(None, shutil.rmtree, str(input_dir.parent), True)
 
 
 @app.get("/")
@@ -199,6 +587,50 @@ async def root():
     }
 
 
+async def save_upload(upload: UploadFile, video_path: Path) -> int:
+    """
+    Copie l'upload sur disque par blocs (mémoire bornée à un bloc)
+    
+    Lève une HTTPException 413 si la vidéo dépasse MAX_UPLOAD_SIZE_MB. Le
+    fichier partiel est supprimé en cas d'erreur.
+    
+    Returns:
+        Taille de la vidéo en octets
+    """
+    total = 0
+    
+    try:
+        async with aiofiles.open(video_path, "wb") as f:
+            while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                total += len(chunk)
+                if total > config.MAX_UPLOAD_SIZE_BYTES:
+                    raise HTTPException(413, f"Vidéo trop volumineuse (max {config.MAX_UPLOAD_SIZE_MB} MB)")
+                await f.write(chunk)
+    except BaseException:
+        video_path.unlink(missing_ok=True)
+        raise
+    
+    return total
+
+
+async def validate_video(video_path: Path):
+    """Lève une HTTPException 400 si la vidéo est illisible, trop courte ou trop petite"""
+    if shutil.which("ffprobe") is None:
+        return  # Sans ffprobe, seule l'extraction des frames fera le tri
+    
+    info = await probe_video(video_path)
+    
+    if info is None:
+        raise HTTPException(400, "Vidéo illisible ou corrompue")
+    
+    # Durée inconnue (certains WebM): l'extraction des frames tranchera
+    if info["duration"] is not None and info["duration"] < MIN_VIDEO_DURATION:
+        raise HTTPException(400, f"Vidéo trop courte ({info['duration']:.1f} s, minimum {MIN_VIDEO_DURATION} secondes)")
+    
+    if info["width"] * info["height"] < MIN_VIDEO_PIXELS:
+        raise HTTPException(400, f"Résolution trop faible ({info['width']}x{info['height']}, minimum 480x270)")
+
+
 @app.post("/generate-3d")
 async def generate_3d(
     background_tasks: BackgroundTasks,
@@ -211,19 +643,26 @@ async def generate_3d(
         job_id = str(uuid.uuid4())
         video_path = UPLOAD_DIR / f"{job_id}.mp4"
         
-        with open(video_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+        file_size = await save_upload(file, video_path)
+        print(f"📥 Vidéo reçue: {file_size / (1024 * 1024):.2f} MB")
+        
+        # Vérification par ffprobe avant d'occuper le GPU
+        try:
+            await validate_video(video_path)
+        except HTTPException:
+            video_path.unlink(missing_ok=True)
+            raise
         
-        jobs_status[job_id] = {
+        await job_store.set(job_id, {
             "job_id": job_id,
             "status": "queued",
             "message": "En attente...",
             "progress": 0,
-            "created_at": datetime.now().isoformat(),
+            "created_at_ns": time.time_ns(),
             "download_url": None,
+            "eta_seconds": None,
             "error": None
-        }
+        })
         
         background_tasks.add_task(process_gaussian_splatting, job_id, video_path)
         
@@ -234,27 +673,39 @@ async def generate_3d(
             "estimated_time": "1-2 minutes"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(500, f"Erreur: {str(e)}")
 
 
 @app.get("/job-status/{job_id}")
 async def get_job_status(job_id: str):
-    if job_id not in jobs_status:
+    job = await job_store.get(job_id)
+    if job is None:
         raise HTTPException(404, "Job non trouvé")
-    return jobs_status[job_id]
+    return format_job(job)
+
+
+@app.get("/job-status/{job_id}/wait")
+async def wait_job_status(job_id: str, since: Optional[int] = None):
+    """Long-poll: répond dès que la progression diffère de `since` (ou après ~25 s)"""
+    job = await job_store.wait(job_id, since)
+    if job is None:
+        raise HTTPException(404, "Job non trouvé")
+    return format_job(job)
 
 
 @app.get("/download/{filename}")
-async def download_model(filename: str):
-    file_path = OUTPUT_DIR / filename
-    if not file_path.exists():
-        raise HTTPException(404, "Fichier non trouvé")
-    
-    return FileResponse(
-        path=str(file_path),
-        media_type="application/octet-stream",
-        filename=filename
+async def download_model(filename: str, request: Request):
+    """Télécharge le PLY (reprise possible, compressé en zstd si le client l'accepte)"""
+    file_path = resolve_download_path(OUTPUT_DIR, filename)
+    
+    return file_download_response(
+        file_path,
+        range_header=request.headers.get("range"),
+        accept_encoding=request.headers.get("accept-encoding"),
+        if_range=request.headers.get("if-range")
     )
 
 
@@ -34,8 +34,11 @@ echo "📍 URL: http://0.0.0.0:8000"
 echo "🎮 GPU: RTX 4090"
 echo "================================================"
 
+# Démarrer le worker GPU (un job à la fois, consomme la file Redis)
+arq main.WorkerSettings &
+
 # Démarrer le serveur avec uvicorn
-# Utiliser --workers 1 car le traitement GPU ne peut pas être parallélisé facilement
+# Le traitement GPU est dans le worker: l'API peut avoir plusieurs workers
 uvicorn main:app \
     --host 0.0.0.0 \
     --port 8000 \
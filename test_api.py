@@ -72,7 +72,12 @@ def test_job_status(job_id: str, max_wait: int = 600):
     
     while True:
         try:
-            response = requests.get(f"{BACKEND_URL}/job-status/{job_id}")
+            # Long-poll: le serveur répond dès que la progression change (ou après ~25 s)
+            response = requests.get(
+                f"{BACKEND_URL}/job-status/{job_id}/wait",
+                params={'since': last_progress},
+                timeout=30
+            )
             
             if response.status_code == 404:
                 print(f"❌ Job non trouvé: {job_id}")
@@ -106,9 +111,6 @@ def test_job_status(job_id: str, max_wait: int = 600):
                 if time.time() - start_time > max_wait:
                     print(f"⏱️ Timeout après {max_wait}s")
                     return None
-                
-                # Attendre avant le prochain poll
-                time.sleep(5)
             else:
                 print(f"❌ Erreur HTTP {response.status_code}")
                 return None
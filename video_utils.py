@@ -0,0 +1,363 @@
+"""
+Extraction de frames vidéo partagée par les backends
+"""
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, Optional
+
+import cv2
+
+try:
+    import av
+except ImportError:  # PyAV optionnel: repli sur OpenCV
+    av = None
+
+try:
+    from turbojpeg import TJSAMP_420, TurboJPEG
+    turbojpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):  # PyTurboJPEG optionnel (libturbojpeg requise)
+    turbojpeg = None
+
+# Threads d'encodage JPEG (OpenCV relâche le GIL pendant imwrite)
+JPEG_WRITERS = max(1, (os.cpu_count() or 2) // 2)
+
+
+def warmup_opencv():
+    """
+    Initialise OpenCV avant le premier job (codecs, backends vidéo)
+
+    Limite aussi ses threads pour laisser des cœurs à COLMAP et à l'encodage JPEG.
+    """
+    cv2.setUseOptimized(True)
+    cv2.setNumThreads(JPEG_WRITERS)
+    cv2.VideoCapture().release()
+
+
+def probe_video_info(video_path: Path) -> Optional[dict]:
+    """
+    Durée et dimensions du premier flux vidéo via ffprobe, sans décoder
+
+    Returns:
+        {"duration": s ou None si inconnue, "width": px, "height": px},
+        None si le fichier est illisible
+    """
+    result = subprocess.run(
+        [
+            "ffprobe", "-v", "error",
+            "-select_streams", "v:0",
+            "-show_entries", "stream=width,height,duration:format=duration",
+            "-of", "json",
+            str(video_path)
+        ],
+        capture_output=True, text=True
+    )
+
+    try:
+        info = json.loads(result.stdout)
+        stream = info["streams"][0]
+        # Durée du flux, sinon du conteneur (absente des flux MKV/WebM, et des
+        # deux dans les WebM d'enregistreurs qui ne la réécrivent pas en fin de fichier)
+        duration = stream.get("duration") or info.get("format", {}).get("duration")
+        return {
+            "duration": float(duration) if duration else None,
+            "width": int(stream["width"]),
+            "height": int(stream["height"])
+        }
+    except (ValueError, KeyError, IndexError):
+        return None
+
+
+def probe_video_duration(video_path: Path) -> float:
+    """Durée de la vidéo en secondes via ffprobe (0 si inconnue)"""
+    info = probe_video_info(video_path)
+    if info is None or info["duration"] is None:
+        return 0.0
+    return info["duration"]
+
+
+async def probe_video(video_path: Path) -> Optional[dict]:
+    """probe_video_info sans bloquer la boucle d'événements"""
+    return await asyncio.get_running_loop().run_in_executor(None, probe_video_info, video_path)
+
+
+def sniff_video_format(header: bytes) -> Optional[str]:
+    """
+    Format du conteneur d'après ses premiers octets ("mp4", "mov", "avi")
+
+    Ne dépend pas du Content-Type envoyé par le client. Retourne None si
+    les octets ne correspondent à aucun conteneur reconnu.
+    """
+    if header[4:8] == b"ftyp":
+        # ISO BMFF; la marque "qt  " désigne QuickTime
+        return "mov" if header[8:12] == b"qt  " else "mp4"
+
+    if header[4:8] in (b"moov", b"mdat", b"wide", b"free", b"skip"):
+        # Ancien QuickTime sans atome ftyp
+        return "mov"
+
+    if header[:4] == b"RIFF" and header[8:12] == b"AVI ":
+        return "avi"
+
+    return None
+
+
+@lru_cache(maxsize=1)
+def ffmpeg_hwaccel() -> str:
+    """
+    Méthode de décodage matériel pour FFmpeg
+
+    "cuda" (NVDEC) si FFmpeg est compilé avec et qu'un GPU NVIDIA est présent,
+    sinon "auto" (FFmpeg choisit, décodage CPU en dernier recours).
+    """
+    if shutil.which("nvidia-smi"):
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-hwaccels"],
+            capture_output=True, text=True
+        )
+        if "cuda" in result.stdout.split():
+            return "cuda"
+
+    return "auto"
+
+
+def extract_frames(
+    video_path: Path,
+    out_dir: Path,
+    target_frames: Optional[int] = None,
+    target_fps: Optional[float] = None,
+    max_dim: int = 1920,
+    jpeg_quality: int = 85
+) -> int:
+    """
+    Extrait des frames d'une vidéo en JPEG (frame_0000.jpg, frame_0001.jpg...)
+
+    Utilise FFmpeg (filtre fps, NVDEC si disponible, encodage JPEG en C),
+    sinon PyAV (décodage multi-thread), sinon OpenCV.
+
+    Args:
+        video_path: Chemin vers la vidéo
+        out_dir: Dossier de sortie pour les frames
+        target_frames: Nombre de frames à extraire, réparties sur toute la vidéo
+        target_fps: Nombre de frames à extraire par seconde de vidéo
+        max_dim: Plus grand côté des frames en pixels (jamais agrandies)
+        jpeg_quality: Qualité JPEG (0-100)
+
+    Avec target_frames et target_fps, la cadence la plus basse l'emporte.
+
+    Returns:
+        Nombre de frames extraites
+    """
+    if target_frames is None and target_fps is None:
+        raise ValueError("target_frames ou target_fps doit être défini")
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    if shutil.which("ffmpeg"):
+        # La répartition sur toute la vidéo demande sa durée
+        duration = probe_video_duration(video_path) if target_frames and shutil.which("ffprobe") else 0.0
+
+        if target_frames is None or duration > 0:
+            rates = [target_fps] if target_fps else []
+            if target_frames:
+                rates.append(target_frames / duration)
+            fps = min(rates)
+            return _extract_frames_ffmpeg(video_path, out_dir, fps, target_frames, max_dim, jpeg_quality)
+
+    if av is not None:
+        frames = _decode_frames_pyav(video_path, target_frames, target_fps)
+    else:
+        frames = _decode_frames_opencv(video_path, target_frames, target_fps)
+
+    return _save_frames(frames, out_dir, target_frames, max_dim, jpeg_quality)
+
+
+def _scale_filter(max_dim: int) -> str:
+    """Filtre FFmpeg de réduction: jamais d'agrandissement, ratio conservé"""
+    return f"scale='min({max_dim},iw)':'min({max_dim},ih)':force_original_aspect_ratio=decrease"
+
+
+def _ffmpeg_qscale(jpeg_quality: int) -> int:
+    """Qualité JPEG (0-100) vers l'échelle -q:v de FFmpeg (2 = meilleure, 31 = pire), approximative"""
+    return max(2, min(31, round((100 - jpeg_quality) * 0.4)))
+
+
+def _extract_frames_ffmpeg(
+    video_path: Path,
+    out_dir: Path,
+    fps: float,
+    max_frames: Optional[int],
+    max_dim: int,
+    jpeg_quality: int
+) -> int:
+    """Extraction en un seul appel FFmpeg avec le filtre fps"""
+    hwaccel = ffmpeg_hwaccel()
+    print(f"🎯 Extraction FFmpeg ({hwaccel}): {fps:.3f} frames/s")
+
+    def ffmpeg_cmd(hwaccel: str) -> list:
+        cmd = [
+            "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+            "-hwaccel", hwaccel,
+            "-i", str(video_path),
+            "-vf", f"fps={fps:.6f},{_scale_filter(max_dim)}",
+            "-q:v", str(_ffmpeg_qscale(jpeg_quality)),
+            "-start_number", "0"
+        ]
+        if max_frames:
+            cmd += ["-frames:v", str(max_frames)]
+        return cmd + [str(out_dir / "frame_%04d.jpg")]
+
+    result = subprocess.run(ffmpeg_cmd(hwaccel), capture_output=True, text=True)
+
+    if result.returncode != 0 and hwaccel == "cuda":
+        # NVDEC indisponible pour ce flux (codec, driver...): repli CPU
+        print(f"⚠️ Décodage NVDEC échoué, repli CPU: {result.stderr.strip()}")
+        result = subprocess.run(ffmpeg_cmd("auto"), capture_output=True, text=True)
+
+    if result.returncode != 0:
+        raise Exception(f"Frame extraction failed: {result.stderr}")
+
+    extracted_count = len(list(out_dir.glob("frame_*.jpg")))
+    print(f"✅ {extracted_count} frames extraites")
+
+    return extracted_count
+
+
+def _frame_interval(
+    video_fps: float,
+    total_frames: int,
+    target_frames: Optional[int],
+    target_fps: Optional[float]
+) -> int:
+    """Pas d'échantillonnage des décodeurs Python: 1 frame gardée toutes les N"""
+    interval = 1
+    if target_fps and video_fps:
+        interval = max(interval, int(video_fps / target_fps))
+    if target_frames and total_frames:
+        interval = max(interval, total_frames // target_frames)
+    return interval
+
+
+def _decode_frames_pyav(
+    video_path: Path,
+    target_frames: Optional[int],
+    target_fps: Optional[float]
+) -> Iterator:
+    """Frames échantillonnées, décodées par PyAV (décodeur FFmpeg multi-thread)"""
+    with av.open(str(video_path)) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        stream.codec_context.thread_count = 0  # 0 = autant de threads que de cœurs
+
+        video_fps = float(stream.average_rate or 0)
+        total_frames = stream.frames
+        if not total_frames and stream.duration and video_fps:
+            total_frames = int(stream.duration * stream.time_base * video_fps)
+
+        interval = _frame_interval(video_fps, total_frames, target_frames, target_fps)
+        print(f"📹 Vidéo: {total_frames} frames à {video_fps:.2f} FPS (PyAV)")
+        print(f"🎯 Extraction: 1 frame tous les {interval} frames")
+
+        for frame_count, frame in enumerate(container.decode(stream)):
+            if frame_count % interval == 0:
+                yield frame.to_ndarray(format="bgr24")
+
+
+def _decode_frames_opencv(
+    video_path: Path,
+    target_frames: Optional[int],
+    target_fps: Optional[float]
+) -> Iterator:
+    """Frames échantillonnées avec OpenCV: seules les frames gardées sont décodées"""
+    cap = cv2.VideoCapture(str(video_path))
+
+    try:
+        video_fps = cap.get(cv2.CAP_PROP_FPS)
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+        interval = _frame_interval(video_fps, total_frames, target_frames, target_fps)
+        print(f"📹 Vidéo: {total_frames} frames à {video_fps:.2f} FPS")
+        print(f"🎯 Extraction: 1 frame tous les {interval} frames")
+
+        frame_count = 0
+
+        # grab() avance sans décoder en BGR, retrieve() décode la frame gardée
+        while cap.grab():
+            if frame_count % interval == 0:
+                ret, frame = cap.retrieve()
+                if not ret:
+                    break
+                yield frame
+
+            frame_count += 1
+    finally:
+        cap.release()
+
+
+def _prepare_frame(frame, max_dim: int):
+    """
+    Réduit la frame à max_dim pixels sur son plus grand côté
+
+    Retourne toujours une nouvelle image: OpenCV réutilise le buffer de
+    décodage, la frame doit être copiée avant l'encodage en arrière-plan.
+    """
+    h, w = frame.shape[:2]
+    scale = min(1.0, max_dim / max(h, w))
+
+    if scale < 1:
+        return cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+    return frame.copy()
+
+
+def _write_jpeg(frame_path: Path, frame, jpeg_quality: int, params: list):
+    """Encode une frame BGR en JPEG: libjpeg-turbo (SIMD) si disponible, sinon OpenCV"""
+    if turbojpeg is not None:
+        # Même sous-échantillonnage 4:2:0 que cv2.imwrite
+        frame_path.write_bytes(turbojpeg.encode(frame, quality=jpeg_quality, jpeg_subsample=TJSAMP_420))
+    elif not cv2.imwrite(str(frame_path), frame, params):
+        raise OSError(f"Écriture de {frame_path} impossible")
+
+
+def _save_frames(
+    frames: Iterator,
+    out_dir: Path,
+    max_frames: Optional[int],
+    max_dim: int,
+    jpeg_quality: int
+) -> int:
+    """Encode les frames en JPEG sur un pool de threads, en parallèle du décodage"""
+    # JPEG baseline sans seconde passe Huffman (optimize): encodage plus rapide
+    params = [
+        cv2.IMWRITE_JPEG_QUALITY, jpeg_quality,
+        cv2.IMWRITE_JPEG_PROGRESSIVE, 0,
+        cv2.IMWRITE_JPEG_OPTIMIZE, 0
+    ]
+    writes = []
+
+    # Le bloc with attend la fin de tous les encodages
+    with ThreadPoolExecutor(max_workers=JPEG_WRITERS) as executor:
+        try:
+            for frame in frames:
+                frame_path = out_dir / f"frame_{len(writes):04d}.jpg"
+                writes.append(executor.submit(
+                    _write_jpeg, frame_path, _prepare_frame(frame, max_dim), jpeg_quality, params
+                ))
+
+                if max_frames and len(writes) >= max_frames:
+                    break
+        finally:
+            frames.close()
+
+    # Remonte la première erreur d'encodage ou d'écriture (disque plein...)
+    for write in writes:
+        write.result()
+    saved_count = len(writes)
+
+    print(f"✅ {saved_count} frames extraites")
+    return saved_count